@@ -0,0 +1,544 @@
+import os
+import sys
+import json
+import time
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import random
+import tempfile
+import tracemalloc
+import argparse
+import bs4 as bs
+import box_office
+
+try:
+    import resource
+except ImportError:
+    #Not available on Windows, peak memory is left out of ingestion results
+    resource = None
+
+#Synthetic screenings are dated one per day starting from this ordinal (2016-02-06)
+FIRST_DAY = 736000
+
+def use_database(path):
+    """
+    Points box_office at a fresh database and returns its connection.
+    """
+    box_office.use_database(path)
+    box_office.id_cache = box_office.IdCache()
+    return box_office.conn
+
+def close_database():
+    """
+    Moves everything in the write-ahead log into the database file and closes it, so the file's
+    size is the size of the data.
+    """
+    box_office.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    box_office.conn.close()
+
+def fill_seats(seat_rows, seats_per_screening):
+    """
+    Adds seat_rows seats spread over screenings of seats_per_screening seats each.
+
+    One screening is added per day so screening lookups by date can be measured as well.
+    """
+    screenings = max(1, seat_rows // seats_per_screening)
+    with box_office.conn:
+        box_office.c.executemany("""INSERT INTO screenings(screening_id, screening_url, movie_location_id,
+                                                          screening_date, screening_time)
+                                    VALUES (?,?,?,?,?)""",
+                                 [(screening, 'url-%s' % screening, screening % 50,
+                                   day_string(FIRST_DAY + screening), '19:30')
+                                  for screening in range(1, screenings + 1)])
+        box_office.c.executemany("""INSERT INTO seats(screening_id, seat_location, seat_type, seat_status)
+                                    VALUES (?,?,'standard','availableSeat')""",
+                                 ((screening, 'S%s' % seat)
+                                  for screening in range(1, screenings + 1)
+                                  for seat in range(seats_per_screening)))
+    return screenings
+
+def day_string(ordinal):
+    """
+    Returns the YYYY-MM-DD string of a proleptic Gregorian ordinal.
+    """
+    return box_office.datetime.date.fromordinal(ordinal).isoformat()
+
+def time_lookups(screenings, seats_per_screening, lookups):
+    """
+    Returns the average milliseconds for a seat dedup probe and a daily screening lookup.
+    """
+    c = box_office.c
+    probes = [(random.randint(1, screenings), 'S%s' % random.randrange(seats_per_screening))
+              for lookup in range(lookups)]
+    start = time.perf_counter()
+    for screening_id, seat_location in probes:
+        c.execute("SELECT seat_id FROM seats WHERE screening_id = ? AND seat_location = ?",
+                  (screening_id, seat_location))
+        c.fetchone()
+    seat_ms = (time.perf_counter() - start) * 1000 / lookups
+
+    days = [day_string(FIRST_DAY + random.randint(1, screenings)) for lookup in range(lookups)]
+    start = time.perf_counter()
+    for day in days:
+        box_office.from_db_get_daily_screenings(day)
+    screening_ms = (time.perf_counter() - start) * 1000 / lookups
+    return seat_ms, screening_ms
+
+def bench_lookups(row_counts, seats_per_screening=300, lookups=200):
+    """
+    Prints seat and screening lookup latency as the seats table grows, before and after the
+    schema migrations add indexes.
+    """
+    print('%12s %12s %14s %14s %14s %14s' % ('seat rows', 'screenings', 'seat ms', 'seat ms idx',
+                                             'date ms', 'date ms idx'))
+    for seat_rows in row_counts:
+        use_database(':memory:')
+        box_office.create_seats_table()
+        box_office.create_screenings_table()
+        screenings = fill_seats(seat_rows, seats_per_screening)
+        before = time_lookups(screenings, seats_per_screening, lookups)
+
+        box_office.create_tables()
+        after = time_lookups(screenings, seats_per_screening, lookups)
+        print('%12s %12s %14.4f %14.4f %14.4f %14.4f' % (seat_rows, screenings, before[0], after[0],
+                                                         before[1], after[1]))
+
+def synthetic_seat_rows(rows=12, seats_per_row=25, sold=0.4):
+    """
+    Returns (seat_location, seat_type, seat_status) tuples for a made up auditorium.
+    """
+    seat_rows = []
+    for row in range(rows):
+        for seat in range(1, seats_per_row + 1):
+            location = '%s%s' % (chr(ord('A') + row), seat)
+            if row == 0 and seat in (1, seats_per_row):
+                seat_rows.append((location, 'unavailableSeat', 'unavailableSeat'))
+            elif row == 0 and seat in (5, 6):
+                seat_rows.append((location, 'wheelchair', 'availableSeat'))
+            else:
+                status = 'reservedSeat' if random.random() < sold else 'availableSeat'
+                seat_rows.append((location, 'standard', status))
+    return seat_rows
+
+def bench_seat_storage(screenings):
+    """
+    Prints database size and write time for seats stored as rows and as packed seat maps.
+    """
+    print('%10s %12s %12s %12s' % ('storage', 'screenings', 'MB', 'seconds'))
+    charts = [synthetic_seat_rows() for screening in range(screenings)]
+    for storage, insert in (('rows', box_office.insert_seats),
+                            ('packed', box_office.insert_seat_map)):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'box_office.db')
+            use_database(path)
+            box_office.create_tables()
+            start = time.perf_counter()
+            for screening_id, seat_rows in enumerate(charts, 1):
+                insert(screening_id, seat_rows)
+            seconds = time.perf_counter() - start
+            close_database()
+            print('%10s %12s %12.2f %12.2f' % (storage, screenings, os.path.getsize(path) / 2**20,
+                                               seconds))
+
+def recursive_check_times(showtimes, lead=box_office.SEAT_CHECK_LEAD):
+    """
+    Assigns check times the way queue_times did before assign_check_times, written as a loop so
+    it can't hit the recursion limit.  Returns the same tuples as assign_check_times.
+    """
+    minute = box_office.datetime.timedelta(minutes=1)
+    seen = set()
+    assigned = []
+    for showtime in showtimes:
+        ideal = showtime - lead * minute
+        check_time = ideal
+        while check_time in seen:
+            check_time -= minute
+        seen.add(check_time)
+        assigned.append((check_time, int((ideal - check_time) / minute)))
+    return assigned
+
+def synthetic_showtimes(count):
+    """
+    Returns count showtimes on one day, all starting on the hour or half hour between noon and
+    10:30 PM the way multiplex showtimes cluster.
+    """
+    day = box_office.datetime.datetime(2018, 1, 25)
+    return [day + box_office.datetime.timedelta(minutes=720 + 30 * random.randrange(22))
+            for showtime in range(count)]
+
+def bench_check_times(count, capacities=(1, 4, 16)):
+    """
+    Prints time taken and how far checks move when assigning check times for count showtimes.
+    """
+    showtimes = synthetic_showtimes(count)
+    print('%14s %10s %12s %14s %14s' % ('method', 'capacity', 'seconds', 'max moved', 'mean moved'))
+    methods = [('recursive', 1, recursive_check_times)]
+    for capacity in capacities:
+        methods.append(('heap', capacity, lambda showtimes, capacity=capacity:
+                        box_office.assign_check_times(showtimes, slot_capacity=capacity)))
+    for name, capacity, method in methods:
+        start = time.perf_counter()
+        assigned = method(showtimes)
+        seconds = time.perf_counter() - start
+        moved = [minutes_moved for check_time, minutes_moved in assigned]
+        print('%14s %10s %12.3f %14s %14.1f' % (name, capacity, seconds, max(moved),
+                                                sum(moved) / len(moved)))
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def bs_get_amenity(showtime_type):
+    """
+    get_amenity as it was written for BeautifulSoup.
+    """
+    show_type = 'Standard'
+    for screening_type in box_office.SCREENING_TYPES:
+        if showtime_type.find('a', {'data-amenity-name': screening_type}):
+            show_type = screening_type
+            break
+
+    if showtime_type.find('a', {'data-amenity-name': 'Reserved seating'}):
+        reserved_seating = 'True'
+    else:
+        reserved_seating = 'False'
+
+    return show_type, reserved_seating
+
+def bs_parse_theater_page(page_source):
+    """
+    parse_theater_page as it was written for BeautifulSoup.
+    """
+    soup = bs.BeautifulSoup(page_source, 'lxml')
+    listing = []
+    for movie in soup.find_all('li', {'class': 'fd-movie'}):
+        title = movie.find('a', {'class': 'dark'}).text
+        screenings = []
+        for variant in movie.find_all('li', {'class': 'fd-movie__showtimes-variant'}):
+            screening_type, reserved_seating = bs_get_amenity(variant)
+            for screening in variant.find_all('a', {'class': 'showtime-btn--available'}):
+                screenings.append((screening['href'], screening_type, reserved_seating))
+        listing.append((title, screenings))
+    return listing
+
+def bs_parse_ticket_prices(page_source):
+    """
+    parse_ticket_prices as it was written for BeautifulSoup.
+    """
+    soup = bs.BeautifulSoup(page_source, 'lxml')
+    if soup.find('section', {'class': 'errorMessages'}):
+        return [soup.find('div', {'class': 'errorHeaderMessage'}).text]
+
+    auditorium = soup.find('h2', {'id': 'auditoriumInfo'})
+    if auditorium is not None:
+        auditorium = auditorium.text
+    prices = []
+    for ticket_row in soup.find('table', {'class': 'quantityTable'}).find_all('tr'):
+        ticket_type = ticket_row.find('input', {'name': 'pricedesc'})
+        price = ticket_row.find('input', {'name': 'price'})
+        prices.append((ticket_type['value'], price['value'], auditorium))
+    return prices
+
+def bs_parse_seat_chart(page_source):
+    """
+    parse_seat_chart as it was written for BeautifulSoup.
+    """
+    soup = bs.BeautifulSoup(page_source, 'lxml')
+    seat_chart = soup.find('div', {'id': 'svg-Layer_1'})
+    return [(seat['id'], seat['class']) for seat in seat_chart.find_all('div')]
+
+def page_padding(elements):
+    """
+    Returns markup that a parser has to read past, standing in for the navigation, scripts and
+    ads that make up most of a real page.
+    """
+    return ''.join('<div class="fd-nav__item"><a href="/nav/%s">Link %s</a><span>%s</span></div>'
+                   % (element, element, 'x' * 40) for element in range(elements))
+
+def synthetic_theater_page(movies=20, variants=2, showtimes=6, padding=3000, theater=0):
+    """
+    Returns a theater listing page with movies x variants x showtimes available showtimes.
+
+    Showtime urls include theater so pages made for different theaters don't share screenings.
+    """
+    amenities = ['Cinemark XD', 'RealD 3D', 'IMAX', None]
+    items = []
+    for movie in range(movies):
+        variant_items = []
+        for variant in range(variants):
+            amenity = amenities[(movie + variant) % len(amenities)]
+            links = ''.join('<li class="fd-movie__btn-list-item"><a class="btn showtime-btn '
+                            'showtime-btn--available" href="https://tickets.example.com/'
+                            'ticketboxoffice.aspx?row_count=%s%02d%02d&amp;tid=T%s&amp;'
+                            'sdate=2018-01-25+%02d:%02d&amp;mid=%s">time</a></li>'
+                            % (movie, variant, showtime, theater, 12 + showtime % 11,
+                               15 * variant + showtime // 11, movie) for showtime in range(showtimes))
+            icons = '<li class="fd-movie__amenity-icon-wrap"><a data-amenity-name="Reserved seating"></a></li>'
+            if amenity:
+                icons += ('<li class="fd-movie__amenity-icon-wrap"><a data-amenity-name="%s"></a></li>'
+                          % amenity)
+            variant_items.append('<li class="fd-movie__showtimes-variant"><ul>%s</ul>'
+                                 '<ol class="fd-movie__btn-list">%s</ol></li>' % (icons, links))
+        items.append('<li class="fd-movie"><div class="fd-movie__details"><a class="dark">Movie %s</a>'
+                     '</div><ul class="fd-movie__showtimes">%s</ul></li>' % (movie, ''.join(variant_items)))
+    return ('<html><body>%s<ul class="fd-theater__movies">%s</ul>%s</body></html>'
+            % (page_padding(padding // 2), ''.join(items), page_padding(padding // 2)))
+
+def synthetic_ticket_page(tickets=4, auditorium=1, padding=1000):
+    """
+    Returns a ticket page with tickets ticket types.
+    """
+    rows = ''.join('<tr><th class="ticketType"><input type="hidden" name="pricedesc" value="Ticket %s">'
+                   '<input type="hidden" name="price" value="%.2f"></th><td class="numberofTickets">'
+                   '<select class="qtyDropDown" id="AreaRepeater_TicketRepeater_0_quantityddl_%s">'
+                   '<option value="0">0</option><option value="1">1</option></select></td></tr>'
+                   % (ticket, 8 + ticket * 1.25, ticket) for ticket in range(tickets))
+    return ('<html><body>%s<h2 id="auditoriumInfo">Auditorium %s</h2>'
+            '<table class="section quantityTable"><tbody class="ticketTypeTable">%s</tbody></table>'
+            '<input type="submit" id="NewCustomerCheckoutButton">%s</body></html>'
+            % (page_padding(padding // 2), auditorium, rows, page_padding(padding // 2)))
+
+def synthetic_seat_page(seat_rows, padding=1000):
+    """
+    Returns a seating chart page for (seat_location, seat_type, seat_status) tuples.
+    """
+    seat_divs = []
+    for location, seat_type, status in seat_rows:
+        classes = status if seat_type == status else '%s %s' % (seat_type, status)
+        seat_divs.append('<div id="%s" class="%s" data-seats="%s--0"></div>' % (location, classes,
+                                                                                location))
+    return ('<html><body>%s<div id="seatMap"><div id="svg-Layer_1">%s</div></div>%s</body></html>'
+            % (page_padding(padding // 2), ''.join(seat_divs), page_padding(padding // 2)))
+
+def measure(parse, page_source, repeat):
+    """
+    Returns the average milliseconds and the peak KB of memory allocated to parse a page.
+
+    Memory is measured with tracemalloc, which sees Python objects but not the buffers libxml2
+    allocates itself, so the lxml figure is a lower bound.
+    """
+    start = time.perf_counter()
+    for run in range(repeat):
+        parse(page_source)
+    milliseconds = (time.perf_counter() - start) * 1000 / repeat
+
+    tracemalloc.start()
+    parse(page_source)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return milliseconds, peak / 1024
+
+def bench_parsers(repeat=20):
+    """
+    Prints parse time and peak memory of the lxml parsers against the old BeautifulSoup ones on
+    the saved fixture pages and on larger synthetic pages.
+    """
+    def fixture(name):
+        with open(os.path.join(FIXTURES, name)) as page:
+            return page.read()
+
+    pages = [('theater fixture', fixture('theater.html'), box_office.parse_theater_page,
+              bs_parse_theater_page),
+             ('tickets fixture', fixture('tickets.html'), box_office.parse_ticket_prices,
+              bs_parse_ticket_prices),
+             ('seats fixture', fixture('seats.html'), box_office.parse_seat_chart,
+              bs_parse_seat_chart),
+             ('theater synthetic', synthetic_theater_page(), box_office.parse_theater_page,
+              bs_parse_theater_page),
+             ('tickets synthetic', synthetic_ticket_page(), box_office.parse_ticket_prices,
+              bs_parse_ticket_prices),
+             ('seats synthetic', synthetic_seat_page(synthetic_seat_rows(20, 30)),
+              box_office.parse_seat_chart, bs_parse_seat_chart)]
+
+    print('%18s %8s %10s %10s %10s %10s %7s' % ('page', 'KB', 'bs4 ms', 'lxml ms', 'bs4 peak',
+                                                'lxml peak', 'same'))
+    for name, page_source, parse, bs_parse in pages:
+        bs_ms, bs_peak = measure(bs_parse, page_source, repeat)
+        lxml_ms, lxml_peak = measure(parse, page_source, repeat)
+        same = parse(page_source) == bs_parse(page_source)
+        print('%18s %8.1f %10.2f %10.2f %9.0fK %9.0fK %7s' % (name, len(page_source) / 1024, bs_ms,
+                                                              lxml_ms, bs_peak, lxml_peak, same))
+
+INGEST_DATE = '2018-01-25'
+
+def synthetic_snapshots(store, theaters, movies, showtimes, seats):
+    """
+    Saves theater, ticket and seating chart pages for theaters x movies x showtimes screenings
+    of seats seats each to store and returns the theater urls.
+    """
+    theater_urls = []
+    for theater in range(theaters):
+        theater_url = 'https://www.example.com/theater-%s/theater-page' % theater
+        page_source = synthetic_theater_page(movies, 1, showtimes, theater=theater)
+        store.save(theater_url, 'page', page_source)
+        for title, screenings in box_office.parse_theater_page(page_source):
+            for screening_url, screening_type, reserved_seating in screenings:
+                store.save(screening_url, 'page', synthetic_ticket_page(auditorium=theater))
+                store.save(screening_url, 'seats',
+                           synthetic_seat_page(synthetic_seat_rows(max(1, seats // 20), 20)))
+        theater_urls.append(theater_url)
+    return theater_urls
+
+def bench_ingestion(theaters, movies, showtimes, seats, workers=1, parse_processes=0):
+    """
+    Runs the -auto path on synthetic pages replayed from a snapshot store and returns throughput,
+    database size and peak memory.
+
+    Pages are generated up front and read back through the replay fetch backend, so only
+    parsing and database writes are timed.  Peak RSS covers the whole process, including page
+    generation.
+    """
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        store = box_office.SnapshotStore(os.path.join(directory, 'snapshots'), 2**40)
+        theater_urls = synthetic_snapshots(store, theaters, movies, showtimes, seats)
+        path = os.path.join(directory, 'box_office.db')
+        use_database(path)
+        box_office.create_tables()
+        for theater_url in theater_urls:
+            box_office.insert_theater(theater_url, theater_url)
+
+        box_office.snapshot_store = store
+        box_office.fetch_backend = 'replay'
+        box_office.refetch_unchanged = True
+        box_office.metrics = box_office.Metrics()
+        if parse_processes:
+            box_office.parse_pool = ProcessPoolExecutor(parse_processes)
+            box_office.parse_processes = parse_processes
+        start = time.perf_counter()
+        box_office.get_theaters(theater_urls, workers)
+        box_office.get_ticket_prices(INGEST_DATE, workers)
+        box_office.replay_seat_data(INGEST_DATE, workers)
+        seconds = time.perf_counter() - start
+        if parse_processes:
+            box_office.parse_pool.shutdown()
+            box_office.parse_pool, box_office.parse_processes = None, 0
+        close_database()
+        store.close()
+
+        screenings = theaters * movies * showtimes
+        results = {'theaters': theaters, 'movies': movies, 'showtimes': showtimes, 'seats': seats,
+                   'seconds': seconds,
+                   'pages_per_second': (theaters + 2 * screenings) / seconds,
+                   'rows_per_second': box_office.metrics.counts['rows'] / seconds,
+                   'db_mb': os.path.getsize(path) / 2**20,
+                   'peak_rss_mb': None}
+    if resource is not None:
+        #ru_maxrss is in KB on Linux
+        results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return results
+
+def print_ingestion(results, baseline=None):
+    """
+    Prints ingestion results next to a saved baseline and the change from it.
+    """
+    print('%18s %12s %12s %10s' % ('measure', 'result', 'baseline', 'change'))
+    for measure in ('seconds', 'pages_per_second', 'rows_per_second', 'db_mb', 'peak_rss_mb'):
+        result = results[measure]
+        if result is None:
+            continue
+        if baseline is None or not baseline.get(measure):
+            print('%18s %12.2f %12s %10s' % (measure, result, '-', '-'))
+        else:
+            print('%18s %12.2f %12.2f %+9.1f%%' % (measure, result, baseline[measure],
+                                                   100 * (result / baseline[measure] - 1)))
+
+STARTUP_COMMANDS = [
+    ('insert theater', ['-insert_theater_name', 'Theater', '-url_theater', 'theater-url']),
+    ('enque', ['-enque']),
+    ('job status', ['-job_status']),
+    ('rebuild earnings', ['-rebuild-earnings']),
+    ('tickets', ['-tickets']),
+    ('daemon', ['-daemon']),
+    ('worker', ['-worker']),
+    ('seats', ['-replay', '-seats', 'https://tickets.example.com/ticketboxoffice.aspx'
+                                    '?row_count=1&sdate=2018-01-25+14:45&mid=1']),
+]
+
+def bench_startup(repeat=3, slowest=5):
+    """
+    Prints how long box_office.py takes to start and run each subcommand, and the imports that
+    took longest, in the format of python -X importtime.
+
+    Commands run against an empty database and snapshot directory in a temporary directory, so
+    commands that fetch pages find nothing to fetch.  -seats is replayed for an unknown screening,
+    which fails and queues a job without starting a browser.  Times are the fastest of
+    repeat runs.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'box_office.py')
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'box_office.db')
+        snapshots = os.path.join(directory, 'snapshots')
+        for name, command in STARTUP_COMMANDS:
+            runs = []
+            for run in range(repeat):
+                start = time.perf_counter()
+                process = subprocess.run([sys.executable, '-X', 'importtime', script, '-st',
+                                          '-db', database, '-snapshot_dir', snapshots] + command,
+                                         cwd=directory, capture_output=True, text=True)
+                runs.append((time.perf_counter() - start, process.stderr))
+            seconds, importtime = min(runs)
+            #Top level imports are indented by one space, the modules they import by more
+            imports = [line for line in importtime.splitlines()
+                       if line.startswith('import time:') and line.split('|')[1].strip().isdigit()
+                       and not line.split('|')[2].startswith('  ')]
+            imports.sort(key=lambda line: int(line.split('|')[1]), reverse=True)
+            print('%s: %.0fms, %.0fms importing'
+                  % (name, seconds * 1000, sum(int(line.split('|')[1]) for line in imports) / 1000))
+            for line in imports[:slowest]:
+                print('    %s' % line)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-lookups', action='store_true',
+                        help='Seat and screening lookup latency as the database grows.')
+    parser.add_argument('-rows', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='Seat row counts to measure with -lookups.')
+    parser.add_argument('-seat_storage', type=int, metavar='SCREENINGS',
+                        help='Database size with seats stored as rows and as packed seat maps.')
+    parser.add_argument('-check_times', type=int, metavar='SHOWTIMES',
+                        help='Seat check time assignment for this many showtimes in one day.')
+    parser.add_argument('-parsers', action='store_true',
+                        help='Parse time and peak memory of the lxml parsers against BeautifulSoup.')
+    parser.add_argument('-ingest', action='store_true',
+                        help='End to end ingestion of synthetic theaters through the replay backend.')
+    parser.add_argument('-theaters', type=int, default=5, help='Theaters to make with -ingest.')
+    parser.add_argument('-movies', type=int, default=10, help='Movies per theater with -ingest.')
+    parser.add_argument('-showtimes', type=int, default=6, help='Showtimes per movie with -ingest.')
+    parser.add_argument('-seats', type=int, default=300, help='Seats per screening with -ingest.')
+    parser.add_argument('-workers', type=int, default=1, help='Fetch threads with -ingest.')
+    parser.add_argument('-parse_processes', type=int, default=0,
+                        help='Processes to parse pages in with -ingest.')
+    parser.add_argument('-startup', action='store_true',
+                        help='Run time and slowest imports of box_office.py commands that do not fetch pages.')
+    parser.add_argument('-baseline', type=str,
+                        help='Results file from -save_baseline to compare -ingest results with.')
+    parser.add_argument('-save_baseline', type=str, help='Saves -ingest results to this file.')
+    args = parser.parse_args()
+
+    if args.lookups:
+        bench_lookups(args.rows)
+    if args.seat_storage:
+        bench_seat_storage(args.seat_storage)
+    if args.check_times:
+        bench_check_times(args.check_times)
+    if args.parsers:
+        bench_parsers()
+    if args.startup:
+        bench_startup()
+    if args.ingest:
+        results = bench_ingestion(args.theaters, args.movies, args.showtimes, args.seats,
+                                  args.workers, args.parse_processes)
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as baseline_file:
+                baseline = json.load(baseline_file)
+            if any(baseline[scale] != results[scale]
+                   for scale in ('theaters', 'movies', 'showtimes', 'seats')):
+                print('Baseline was measured at a different scale')
+        box_office.metrics.report()
+        print_ingestion(results, baseline)
+        if args.save_baseline:
+            with open(args.save_baseline, 'w') as baseline_file:
+                json.dump(results, baseline_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,88 @@ import time
 import datetime
 import re
 import argparse
-import subprocess
 import sqlite3
-import bs4 as bs
-from selenium import webdriver
+import threading
+import os
+import gzip
+import contextlib
+import collections
+import functools
+import hashlib
+import heapq
+import json
+import math
+import pathlib
+import queue
+import random
+import urllib.parse
+
+#selenium, lxml, urllib3, subprocess, socket and concurrent.futures are imported by the functions
+#that use them, so commands that don't fetch or parse pages start without loading them.
+
+
+#Seat statuses in the order of their codes in seat_maps.seat_statuses
+SEAT_STATUSES = ('availableSeat', 'reservedSeat', 'unavailableSeat')
+
+SCREENING_CACHE_SIZE = 5000
+SEAT_CHECK_LEAD = 3
+#Minutes before a showtime that -sample_offsets samples seats at by default
+SEAT_SAMPLE_OFFSETS = (1440, 360, 60, 3)
+JOB_LEASE_SECONDS = 300
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 60
+BROWSER_POOL_SIZE = 2
+BROWSER_MAX_PAGES = 50
+PAGE_TIMEOUT = 15
+DOMAIN_REQUEST_INTERVAL = 0.5
+HTTP_POOL_SIZE = 4
+PIPELINE_QUEUE_SIZE = 16
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 2
+FETCH_BACKOFF_MAX = 60
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 120
+SNAPSHOT_DIR = "D:\\box_office\\snapshots"
+SNAPSHOT_MAX_MB = 2048
+DB_PATH = "D:\\box_office\\box_office.db"
+DB_BUSY_TIMEOUT = 30
+DB_CACHE_MB = 64
+DB_MMAP_MB = 256
+
+#Connection and cursor used by every function, opened by use_database
+conn = None
+c = None
+
+def connect(path=DB_PATH, read_only=False):
+    """
+    Returns a connection to the database at path with the pragmas every connection uses.
+
+    WAL lets read-only connections and other processes read while one process writes, and the
+    busy timeout makes a process wait DB_BUSY_TIMEOUT seconds for a lock instead of failing.
+    synchronous=NORMAL is safe with WAL, a power cut can lose the last transactions but can't
+    corrupt the database.
+    """
+    if read_only:
+        uri = '%s?mode=ro' % pathlib.Path(path).absolute().as_uri()
+        connection = sqlite3.connect(uri, uri=True, timeout=DB_BUSY_TIMEOUT)
+    else:
+        connection = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA cache_size=%d" % (-1024 * DB_CACHE_MB))
+    connection.execute("PRAGMA mmap_size=%d" % (DB_MMAP_MB * 2**20))
+    return connection
 
+def use_database(path=DB_PATH):
+    """
+    Opens the database at path as the connection used by every function.
 
-conn = sqlite3.connect("D:\\box_office\\box_office.db")
-c = conn.cursor()
+    Only the thread that opened it may use the connection.  Worker threads fetch and parse pages
+    and hand results back to it to be written.
+    """
+    global conn, c
+    conn = connect(path)
+    c = conn.cursor()
 
 def create_theaters_table():
     """
@@ -137,7 +211,7 @@ def create_seats_table():
 
 def create_tables():
     """
-    Creates every table in sqlite3 database.
+    Creates every table in sqlite3 database and brings the schema up to date.
     """
     create_theaters_table()
     create_movies_table()
@@ -145,6 +219,363 @@ def create_tables():
     create_screenings_table()
     create_tickets_table()
     create_seats_table()
+    migrate()
+
+def migration_add_indexes():
+    """
+    Adds unique indexes used by the insert functions to skip duplicates and indexes for looking up
+    screenings by date and rows by their parent.
+
+    Duplicate seats, tickets and movie locations left by older versions are removed first.
+    Screenings pointing at a duplicate movie location are moved to the one that is kept.
+    """
+    c.execute("""DELETE FROM seats WHERE seat_id NOT IN
+                     (SELECT MIN(seat_id) FROM seats GROUP BY screening_id, seat_location)""")
+    c.execute("""DELETE FROM tickets WHERE ticket_id NOT IN
+                     (SELECT MIN(ticket_id) FROM tickets GROUP BY screening_id, ticket_desc)""")
+    c.execute("""UPDATE screenings SET movie_location_id =
+                     (SELECT MIN(kept.movie_location_id) FROM movie_locations AS duplicate
+                      INNER JOIN movie_locations AS kept
+                      ON kept.movie_id = duplicate.movie_id AND kept.theater_id = duplicate.theater_id
+                      WHERE duplicate.movie_location_id = screenings.movie_location_id)
+                 WHERE movie_location_id IN (SELECT movie_location_id FROM movie_locations)""")
+    c.execute("""DELETE FROM movie_locations WHERE movie_location_id NOT IN
+                     (SELECT MIN(movie_location_id) FROM movie_locations
+                      GROUP BY movie_id, theater_id)""")
+
+    c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS seats_screening_location
+                     ON seats(screening_id, seat_location)""")
+    c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS tickets_screening_desc
+                     ON tickets(screening_id, ticket_desc)""")
+    c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS movie_locations_movie_theater
+                     ON movie_locations(movie_id, theater_id)""")
+    c.execute("""CREATE INDEX IF NOT EXISTS movie_locations_theater
+                     ON movie_locations(theater_id)""")
+    c.execute("""CREATE INDEX IF NOT EXISTS screenings_date_time
+                     ON screenings(screening_date, screening_time)""")
+    c.execute("""CREATE INDEX IF NOT EXISTS screenings_movie_location
+                     ON screenings(movie_location_id)""")
+
+def migration_add_seat_maps():
+    """
+    Adds tables for storing a screening's seating chart as one row.
+
+    seat_layouts holds the location and type of every seat in an auditorium as a JSON list of
+    [seat_location, seat_type] pairs.  layout_fingerprint is a hash of that list so screenings in
+    the same auditorium share one layout.
+
+    seat_maps holds one byte per seat of a layout with the seat's status as an index into
+    SEAT_STATUSES.
+    """
+    c.execute("""CREATE TABLE IF NOT EXISTS seat_layouts(
+                     seat_layout_id INTEGER,
+                     layout_fingerprint TEXT UNIQUE NOT NULL,
+                     seat_layout TEXT NOT NULL,
+                     PRIMARY KEY(seat_layout_id))""")
+    c.execute("""CREATE TABLE IF NOT EXISTS seat_maps(
+                     screening_id INTEGER,
+                     seat_layout_id INTEGER NOT NULL,
+                     seat_statuses BLOB NOT NULL,
+                     PRIMARY KEY(screening_id),
+                     FOREIGN KEY(screening_id) REFERENCES screenings(screening_id),
+                     FOREIGN KEY(seat_layout_id) REFERENCES seat_layouts(seat_layout_id))""")
+
+def migration_add_page_versions():
+    """
+    Adds page_versions table holding a hash of the last processed copy of a theater or ticket
+    page, plus the ETag and Last-Modified headers it was served with.
+    """
+    c.execute("""CREATE TABLE IF NOT EXISTS page_versions(
+                     page_url TEXT,
+                     content_hash TEXT NOT NULL,
+                     etag TEXT,
+                     last_modified TEXT,
+                     PRIMARY KEY(page_url))""")
+
+def migration_add_jobs():
+    """
+    Adds jobs table used as a work queue shared by worker processes.
+
+    job_type is 'theater', 'tickets' or 'seats' and job_key is the theater or screening url.
+    status is 'pending', 'running', 'done' or 'failed'.  A running job belongs to lease_owner
+    until lease_expires, after which any worker may claim it again.  available_at, lease_expires
+    are unix timestamps.
+    """
+    c.execute("""CREATE TABLE IF NOT EXISTS jobs(
+                     job_id INTEGER,
+                     job_type TEXT NOT NULL,
+                     job_key TEXT NOT NULL,
+                     job_date TEXT NOT NULL,
+                     status TEXT NOT NULL DEFAULT 'pending',
+                     attempts INTEGER NOT NULL DEFAULT 0,
+                     available_at REAL NOT NULL,
+                     lease_owner TEXT,
+                     lease_expires REAL,
+                     last_error TEXT,
+                     PRIMARY KEY(job_id),
+                     UNIQUE(job_type, job_key, job_date))""")
+    c.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, available_at)")
+
+def migration_add_seat_samples():
+    """
+    Adds seat_samples and seat_changes tables recording how a screening's seats sell over time.
+
+    Every time seats are sampled a seat_samples row records the counts, and seat_changes gets a
+    row for each seat whose status differs from the previous sample, with seat_status as an
+    index into SEAT_STATUSES.  The first sample of a screening records every seat.
+    """
+    c.execute("""CREATE TABLE IF NOT EXISTS seat_samples(
+                     sample_id INTEGER,
+                     screening_id INTEGER NOT NULL,
+                     sampled_at TEXT NOT NULL,
+                     screening_capacity INTEGER NOT NULL,
+                     seats_sold INTEGER NOT NULL,
+                     PRIMARY KEY(sample_id),
+                     FOREIGN KEY(screening_id) REFERENCES screenings(screening_id))""")
+    c.execute("CREATE INDEX IF NOT EXISTS seat_samples_screening ON seat_samples(screening_id, sampled_at)")
+    c.execute("""CREATE TABLE IF NOT EXISTS seat_changes(
+                     sample_id INTEGER NOT NULL,
+                     seat_location TEXT NOT NULL,
+                     seat_status INTEGER NOT NULL,
+                     PRIMARY KEY(sample_id, seat_location),
+                     FOREIGN KEY(sample_id) REFERENCES seat_samples(sample_id)) WITHOUT ROWID""")
+
+def migration_add_auditorium_layouts():
+    """
+    Adds auditorium_layouts table recording the seat layout last seen in each auditorium of a
+    theater.  screening_auditorium is the name from the ticket page, e.g. 'Auditorium 9'.
+    """
+    c.execute("""CREATE TABLE IF NOT EXISTS auditorium_layouts(
+                     theater_id INTEGER NOT NULL,
+                     screening_auditorium TEXT NOT NULL,
+                     seat_layout_id INTEGER NOT NULL,
+                     learned_at TEXT NOT NULL,
+                     PRIMARY KEY(theater_id, screening_auditorium),
+                     FOREIGN KEY(theater_id) REFERENCES theaters(theater_id),
+                     FOREIGN KEY(seat_layout_id) REFERENCES seat_layouts(seat_layout_id))""")
+
+def migration_add_job_deadlines():
+    """
+    Adds deadline to jobs, the unix time of the showtime a tickets or seats job is for.
+
+    Jobs are claimed earliest deadline first, after jobs without one.  A pending job whose deadline
+    passes before it is claimed gets status 'missed'.
+    """
+    c.execute("ALTER TABLE jobs ADD COLUMN deadline REAL")
+
+#Schema changes applied after the tables are created.  A database's user_version is the number of
+#migrations it has already run.  Only ever add to the end of this list.
+MIGRATIONS = [
+    migration_add_indexes,
+    migration_add_seat_maps,
+    migration_add_page_versions,
+    migration_add_jobs,
+    migration_add_seat_samples,
+    migration_add_auditorium_layouts,
+    migration_add_job_deadlines,
+]
+
+def migrate():
+    """
+    Runs every migration the database has not run yet, each in its own transaction.
+
+    sqlite3 doesn't begin a transaction for CREATE or ALTER by itself, so one is begun explicitly
+    and a migration that fails part way leaves neither its changes nor a new user_version.
+    """
+    c.execute("PRAGMA user_version")
+    version = c.fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        with conn:
+            if not conn.in_transaction:
+                c.execute("BEGIN")
+            migration()
+            c.execute("PRAGMA user_version = %d" % number)
+
+class IdCache:
+    """
+    Maps natural keys to ids so ingestion doesn't need a query for every lookup.
+
+    theaters are keyed by url, movies by title, movie_locations by (movie_id, theater_id) and
+    screenings by url.  Only the max_screenings most recently used screenings are kept.
+    auditorium_layouts are keyed by (theater_id, screening_auditorium) and hold
+    (seat_layout_id, (seat_location, seat_type) pairs) so a seat check can be matched to its
+    layout without reading it.
+    """
+    def __init__(self, max_screenings=SCREENING_CACHE_SIZE):
+        self.max_screenings = max_screenings
+        self.ids = {'theaters': {}, 'movies': {}, 'movie_locations': {},
+                    'screenings': collections.OrderedDict(), 'auditorium_layouts': {}}
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def get(self, table, key):
+        """
+        Returns the id stored for key or None.
+        """
+        ids = self.ids[table]
+        row_id = ids.get(key)
+        if row_id is None:
+            self.misses[table] += 1
+            return None
+        self.hits[table] += 1
+        if table == 'screenings':
+            ids.move_to_end(key)
+        return row_id
+
+    def add(self, table, key, row_id):
+        """
+        Stores the id for key, evicting the least recently used screening if there are too many.
+        """
+        ids = self.ids[table]
+        ids[key] = row_id
+        if table == 'screenings':
+            ids.move_to_end(key)
+            if len(ids) > self.max_screenings:
+                ids.popitem(last=False)
+
+    def discard(self, table, key):
+        """
+        Forgets the id stored for key, if any.
+        """
+        self.ids[table].pop(key, None)
+
+    def warm(self):
+        """
+        Loads every theater, movie and movie location plus the newest screenings.
+        """
+        c.execute("SELECT theater_url, theater_id FROM theaters")
+        self.ids['theaters'] = dict(c.fetchall())
+        c.execute("SELECT movie_title, movie_id FROM movies")
+        self.ids['movies'] = dict(c.fetchall())
+        c.execute("SELECT movie_id, theater_id, movie_location_id FROM movie_locations")
+        self.ids['movie_locations'] = {(movie_id, theater_id): movie_location_id
+                                       for movie_id, theater_id, movie_location_id in c.fetchall()}
+        c.execute("""SELECT screening_url, screening_id FROM screenings
+                     ORDER BY screening_id DESC LIMIT ?""", (self.max_screenings,))
+        self.ids['screenings'] = collections.OrderedDict(reversed(c.fetchall()))
+
+    def hit_rate(self, table=None):
+        """
+        Returns the fraction of lookups answered from the cache, for one table or all of them.
+        """
+        if table is None:
+            hits, misses = sum(self.hits.values()), sum(self.misses.values())
+        else:
+            hits, misses = self.hits[table], self.misses[table]
+        if hits + misses == 0:
+            return 0.0
+        return hits / (hits + misses)
+
+    def report(self):
+        """
+        Prints lookups and hit rate for each table.
+        """
+        for table in self.ids:
+            print('%s: %s hits, %s misses (%.1f%%)' % (table, self.hits[table], self.misses[table],
+                                                      100 * self.hit_rate(table)))
+
+id_cache = IdCache()
+
+class Metrics:
+    """
+    Records how long each stage of a run takes and how many rows it writes.
+
+    Stages are 'fetch', 'parse', 'write', 'rollup' and 'pipeline', a whole Pipeline run tagged with
+    its name instead of a url.  Each timing is kept with the url of the
+    theater or screening page it was for and, for theater pages, the url of the theater, so slow
+    pages and theaters can be found in the exported samples.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.samples = []
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, stage, url=None, theater_url=None):
+        """
+        Times the body of a with block as one sample of stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            sample = (stage, url, time.perf_counter() - start, time.time(), theater_url)
+            with self.lock:
+                self.samples.append(sample)
+
+    def count(self, name, amount=1):
+        """
+        Adds amount to the counter name.
+        """
+        with self.lock:
+            self.counts[name] += amount
+
+    def percentile(self, stage, fraction):
+        """
+        Returns the duration in seconds that fraction of stage's samples took at most, or None.
+        Uses the nearest rank, so it is always one of the recorded durations.
+        """
+        durations = sorted(sample[2] for sample in self.samples if sample[0] == stage)
+        if not durations:
+            return None
+        #Rounded first so float error like 0.07 * 100 = 7.000000000000001 can't move up a rank
+        return durations[max(0, math.ceil(round(fraction * len(durations), 9)) - 1)]
+
+    def stages(self):
+        """
+        Returns the stages that have samples in the order they were first recorded.
+        """
+        return list(dict.fromkeys(sample[0] for sample in self.samples))
+
+    def report(self):
+        """
+        Prints the sample count, total time, p50 and p95 of each stage and rows written per second.
+        """
+        for stage in self.stages():
+            durations = [sample[2] for sample in self.samples if sample[0] == stage]
+            print('%s: %s samples, %.2fs total, p50 %.1fms, p95 %.1fms'
+                  % (stage, len(durations), sum(durations),
+                     1000 * self.percentile(stage, 0.50), 1000 * self.percentile(stage, 0.95)))
+        elapsed = time.perf_counter() - self.started
+        print('%s rows written in %.1fs (%.1f rows/s)'
+              % (self.counts['rows'], elapsed, self.counts['rows'] / elapsed))
+        if self.counts['missed_deadlines']:
+            print('%s pages were not fetched before their screening started'
+                  % self.counts['missed_deadlines'])
+        for name, value in sorted(self.counts.items()):
+            if name not in ('rows', 'missed_deadlines'):
+                print('%s: %s' % (name, value))
+
+    def export(self, path):
+        """
+        Writes metrics to path, as Prometheus text if it ends in .prom or JSON lines otherwise.
+
+        JSON lines has one object per sample followed by one per counter.
+        """
+        with open(path, 'w') as metrics_file:
+            if path.endswith('.prom'):
+                metrics_file.write('# TYPE box_office_stage_seconds summary\n')
+                for stage in self.stages():
+                    durations = [sample[2] for sample in self.samples if sample[0] == stage]
+                    for quantile in (0.5, 0.95):
+                        metrics_file.write('box_office_stage_seconds{stage="%s",quantile="%s"} %f\n'
+                                           % (stage, quantile, self.percentile(stage, quantile)))
+                    metrics_file.write('box_office_stage_seconds_sum{stage="%s"} %f\n'
+                                       % (stage, sum(durations)))
+                    metrics_file.write('box_office_stage_seconds_count{stage="%s"} %d\n'
+                                       % (stage, len(durations)))
+                for name, value in sorted(self.counts.items()):
+                    metrics_file.write('# TYPE box_office_%s_total counter\n' % name)
+                    metrics_file.write('box_office_%s_total %d\n' % (name, value))
+            else:
+                for stage, url, seconds, recorded, theater_url in self.samples:
+                    metrics_file.write(json.dumps({'stage': stage, 'url': url, 'theater': theater_url,
+                                                   'seconds': seconds, 'time': recorded}) + '\n')
+                for name, value in sorted(self.counts.items()):
+                    metrics_file.write(json.dumps({'counter': name, 'value': value}) + '\n')
+
+metrics = Metrics()
 
 def insert_theater(theater_name, theater_url):
     """
@@ -154,6 +585,7 @@ def insert_theater(theater_name, theater_url):
         with conn:
             c.execute("INSERT INTO theaters(theater_name, theater_url) VALUES (?, ?)",
                       (theater_name, theater_url))
+        id_cache.add('theaters', theater_url, c.lastrowid)
     except sqlite3.IntegrityError:
         print('Could not add theater.  Theater: %s exists in database' % theater_name)
 
@@ -165,6 +597,7 @@ def insert_movie(movie_title):
         with conn:
             c.execute("INSERT INTO movies(movie_title) VALUES (?)",
                       (movie_title,))
+        id_cache.add('movies', movie_title, c.lastrowid)
     except sqlite3.IntegrityError:
         print('Could not add movie.  Movie: %s exists in database' % movie_title)
 
@@ -172,16 +605,17 @@ def insert_movie_location(movie_id, theater_id):
     """
     Only adds a movie playing at a theater if it has not been found in the database.
     """
+    key = (movie_id, theater_id)
+    if id_cache.get('movie_locations', key) is not None:
+        print("Movie with id %s has already been added to this location" % movie_id)
+        return
     try:
         with conn:
-            c.execute("""SELECT movie_location_id
-                         FROM movie_locations
-                         WHERE movie_id = ? AND theater_id = ?""",
+            c.execute("""INSERT INTO movie_locations(movie_id, theater_id) VALUES (?, ?)
+                         ON CONFLICT(movie_id, theater_id) DO NOTHING""",
                       (movie_id, theater_id))
-            data = c.fetchone()
-            if data is None:
-                c.execute("INSERT INTO movie_locations(movie_id, theater_id) VALUES (?, ?)",
-                          (movie_id, theater_id))
+            if c.rowcount:
+                id_cache.add('movie_locations', key, c.lastrowid)
             else:
                 print("Movie with id %s has already been added to this location" % movie_id)
     except sqlite3.IntegrityError:
@@ -206,6 +640,7 @@ def insert_screening(screening_url, movie_location_id, screening_date_time,
                         ) VALUES (?,?,?,?,?,?)""",
                       (screening_url, movie_location_id, screening_date_time[0],
                        screening_date_time[1], screening_type, reserved_seating))
+        id_cache.add('screenings', screening_url, c.lastrowid)
     except sqlite3.IntegrityError:
         print('Could not add screening for %s at %s' % (movie_location_id, screening_date_time[1]))
 
@@ -215,14 +650,12 @@ def insert_ticket(screening_id, ticket_desc, ticket_price):
     """
     try:
         with conn:
-            c.execute("SELECT ticket_id FROM tickets WHERE screening_id = ? AND ticket_desc = ?",
-                      (screening_id, ticket_desc))
-            data = c.fetchone()
-            if data is None:
-                c.execute("""INSERT INTO tickets(screening_id, ticket_desc, ticket_price)
-                             VALUES (?,?,?)""",
-                          (screening_id, ticket_desc, ticket_price))
-            else:
+            c.execute("""INSERT INTO tickets(screening_id, ticket_desc, ticket_price)
+                         VALUES (?,?,?)
+                         ON CONFLICT(screening_id, ticket_desc) DO NOTHING""",
+                      (screening_id, ticket_desc, ticket_price))
+            metrics.count('rows', c.rowcount)
+            if not c.rowcount:
                 print("Ticket data has already been added for screening: %s" % screening_id)
     except sqlite3.IntegrityError:
         print("Error inserting ticket data")
@@ -233,26 +666,322 @@ def insert_seat(screening_id, seat_location, seat_type, seat_status):
     """
     try:
         with conn:
-            c.execute("SELECT seat_id FROM seats WHERE screening_id = ? AND seat_location = ?",
-                      (screening_id, seat_location))
-            data = c.fetchone()
-            if data is None:
-                c.execute("""INSERT INTO seats(screening_id, seat_location, seat_type, seat_status)
-                             VALUES (?,?,?,?)""",
-                          (screening_id, seat_location, seat_type, seat_status))
-            else:
+            c.execute("""INSERT INTO seats(screening_id, seat_location, seat_type, seat_status)
+                         VALUES (?,?,?,?)
+                         ON CONFLICT(screening_id, seat_location) DO NOTHING""",
+                      (screening_id, seat_location, seat_type, seat_status))
+            if not c.rowcount:
                 print("Seat: %s has already been added for this screening" % seat_location)
     except sqlite3.IntegrityError:
         print("Error inserting seat")
 
+def insert_seats(screening_id, seat_rows, screening_url=None):
+    """
+    Adds seat data for an entire screening to seats table in sqlite3 database.
+
+    seat_rows is a list of (seat_location, seat_type, seat_status) tuples.  Every seat is written
+    in a single transaction.  Seats already stored for the screening are left untouched, the same
+    as insert_seat.  screening_url only tags the write in metrics.
+    """
+    try:
+        with metrics.timer('write', screening_url), conn:
+            c.executemany("""INSERT INTO seats(screening_id, seat_location, seat_type, seat_status)
+                             VALUES (?,?,?,?)
+                             ON CONFLICT(screening_id, seat_location) DO NOTHING""",
+                          [(screening_id, location, seat_type, status)
+                           for location, seat_type, status in seat_rows])
+        metrics.count('rows', c.rowcount)
+    except sqlite3.IntegrityError:
+        print("Error inserting seats")
+
+def insert_theater_listing(theater_id, listing, theater_url=None):
+    """
+    Adds movies, movie locations and screenings found on a theater page in one transaction.
+
+    listing is the list returned by parse_theater_page.  Movies, movie locations and screenings
+    that are already in the database are skipped.  Ids are resolved through id_cache, which is
+    only updated once the transaction has been committed.  theater_url only tags the write in
+    metrics.
+    """
+    added = []
+    try:
+        with metrics.timer('write', theater_url, theater_url), conn:
+            for title, screenings in listing:
+                movie_id = id_cache.get('movies', title)
+                if movie_id is None:
+                    c.execute("""INSERT INTO movies(movie_title) VALUES (?)
+                                 ON CONFLICT(movie_title) DO NOTHING""", (title,))
+                    if c.rowcount:
+                        movie_id = c.lastrowid
+                    else:
+                        c.execute("SELECT movie_id FROM movies WHERE movie_title = ?", (title,))
+                        movie_id = c.fetchone()[0]
+                    added.append(('movies', title, movie_id))
+
+                key = (movie_id, theater_id)
+                movie_location_id = id_cache.get('movie_locations', key)
+                if movie_location_id is None:
+                    c.execute("""INSERT INTO movie_locations(movie_id, theater_id) VALUES (?, ?)
+                                 ON CONFLICT(movie_id, theater_id) DO NOTHING""",
+                              (movie_id, theater_id))
+                    if c.rowcount:
+                        movie_location_id = c.lastrowid
+                    else:
+                        c.execute("""SELECT movie_location_id FROM movie_locations
+                                     WHERE movie_id = ? AND theater_id = ?""",
+                                  (movie_id, theater_id))
+                        movie_location_id = c.fetchone()[0]
+                    added.append(('movie_locations', key, movie_location_id))
+
+                c.executemany("""INSERT INTO screenings(
+                                     screening_url,
+                                     movie_location_id,
+                                     screening_date,
+                                     screening_time,
+                                     screening_type,
+                                     reserved_seating
+                                 ) VALUES (?,?,?,?,?,?)
+                                 ON CONFLICT(screening_url) DO NOTHING""",
+                              [(screening_url, movie_location_id) + get_time_date(screening_url) +
+                               (screening_type, reserved_seating)
+                               for screening_url, screening_type, reserved_seating in screenings])
+                metrics.count('rows', c.rowcount)
+    except sqlite3.IntegrityError:
+        print("Could not add showtimes for theater with id %s" % theater_id)
+        return
+    for table, key, row_id in added:
+        id_cache.add(table, key, row_id)
+
+def pack_statuses(seat_rows):
+    """
+    Returns the statuses of a list of (seat_location, seat_type, seat_status) tuples as bytes
+    with one SEAT_STATUSES index per seat.  Raises ValueError for a status not in SEAT_STATUSES.
+    """
+    return bytes(SEAT_STATUSES.index(status) for location, seat_type, status in seat_rows)
+
+def pack_seats(seat_rows):
+    """
+    Returns the layout and packed statuses of a list of (seat_location, seat_type, seat_status)
+    tuples.
+
+    The layout is a list of [seat_location, seat_type] pairs.  See pack_statuses.
+    """
+    layout = [[location, seat_type] for location, seat_type, status in seat_rows]
+    return layout, pack_statuses(seat_rows)
+
+def unpack_seats(layout, statuses):
+    """
+    Returns the (seat_location, seat_type, seat_status) tuples of a packed seating chart.
+    """
+    return [(location, seat_type, SEAT_STATUSES[code])
+            for (location, seat_type), code in zip(layout, statuses)]
+
+def layout_fingerprint(layout):
+    """
+    Returns a hash identifying a seat layout.
+    """
+    return hashlib.sha1(json.dumps(layout).encode('utf-8')).hexdigest()
+
+def insert_seat_layout(layout):
+    """
+    Adds a seat layout unless an identical one is stored and returns its seat_layout_id.
+    Must be called inside a transaction.
+    """
+    fingerprint = layout_fingerprint(layout)
+    c.execute("""INSERT INTO seat_layouts(layout_fingerprint, seat_layout) VALUES (?, ?)
+                 ON CONFLICT(layout_fingerprint) DO NOTHING""",
+              (fingerprint, json.dumps(layout)))
+    if c.rowcount:
+        return c.lastrowid
+    c.execute("SELECT seat_layout_id FROM seat_layouts WHERE layout_fingerprint = ?",
+              (fingerprint,))
+    return c.fetchone()[0]
+
+def from_db_get_auditorium(screening_id):
+    """
+    Returns (theater_id, screening_auditorium) for a screening or None if its auditorium is not
+    known yet.
+    """
+    c.execute("""SELECT theater_id, screening_auditorium FROM screenings
+                 INNER JOIN movie_locations
+                 ON movie_locations.movie_location_id = screenings.movie_location_id
+                 WHERE screening_id = ? AND screening_auditorium IS NOT NULL""",
+              (screening_id,))
+    return c.fetchone()
+
+def from_db_get_auditorium_layout(auditorium):
+    """
+    Returns (seat_layout_id, (seat_location, seat_type) pairs) of the layout recorded for a
+    (theater_id, screening_auditorium) or None, from id_cache when it has been read before.
+    """
+    known = id_cache.get('auditorium_layouts', auditorium)
+    if known is not None:
+        return known
+    c.execute("""SELECT seat_layouts.seat_layout_id, seat_layout FROM auditorium_layouts
+                 INNER JOIN seat_layouts ON seat_layouts.seat_layout_id = auditorium_layouts.seat_layout_id
+                 WHERE theater_id = ? AND screening_auditorium = ?""",
+              auditorium)
+    data = c.fetchone()
+    if data is None:
+        return None
+    known = data[0], tuple(map(tuple, json.loads(data[1])))
+    id_cache.add('auditorium_layouts', auditorium, known)
+    return known
+
+def auditorium_seat_layout_id(screening_id, seat_rows):
+    """
+    Returns the seat_layout_id for a screening's seats, looking it up by auditorium.  Must be
+    called inside a transaction.
+
+    Once an auditorium's layout is known only the seat locations and types are compared with it,
+    the layout isn't serialised, hashed or stored again.  When they no longer match, for instance
+    after seats were removed or a seat became unavailable, the new layout is stored and recorded
+    in its place.
+    """
+    auditorium = from_db_get_auditorium(screening_id)
+    if auditorium is not None:
+        known = from_db_get_auditorium_layout(auditorium)
+        if known is not None and known[1] == tuple(seat[:2] for seat in seat_rows):
+            return known[0]
+
+    seat_layout_id = insert_seat_layout([[location, seat_type]
+                                         for location, seat_type, status in seat_rows])
+    if auditorium is None:
+        return seat_layout_id
+    #Read back once this transaction has committed
+    id_cache.discard('auditorium_layouts', auditorium)
+    if known is not None:
+        print('Seat layout of %s at theater %s changed' % (auditorium[1], auditorium[0]))
+    c.execute("""INSERT INTO auditorium_layouts(theater_id, screening_auditorium, seat_layout_id, learned_at)
+                 VALUES (?,?,?,?)
+                 ON CONFLICT(theater_id, screening_auditorium)
+                 DO UPDATE SET seat_layout_id = excluded.seat_layout_id, learned_at = excluded.learned_at""",
+              auditorium + (seat_layout_id, datetime.datetime.now().isoformat(timespec='seconds')))
+    return seat_layout_id
+
+def insert_seat_map(screening_id, seat_rows, screening_url=None):
+    """
+    Adds seat data for an entire screening to seat_maps table as a single row.
+
+    Like insert_seats, a screening that already has seat data is left untouched.  The layout is
+    looked up with auditorium_seat_layout_id, so once an auditorium's layout is known only the
+    statuses are packed and written.  screening_url only tags the write in metrics.
+    """
+    statuses = pack_statuses(seat_rows)
+    try:
+        with metrics.timer('write', screening_url), conn:
+            seat_layout_id = auditorium_seat_layout_id(screening_id, seat_rows)
+            c.execute("""INSERT INTO seat_maps(screening_id, seat_layout_id, seat_statuses)
+                         VALUES (?,?,?)
+                         ON CONFLICT(screening_id) DO NOTHING""",
+                      (screening_id, seat_layout_id, statuses))
+            metrics.count('rows', c.rowcount)
+            if not c.rowcount:
+                print("Seats have already been added for screening: %s" % screening_id)
+    except sqlite3.IntegrityError:
+        print("Error inserting seat map")
+
+def from_db_get_seat_map(screening_id):
+    """
+    Returns the (seat_location, seat_type, seat_status) tuples stored in seat_maps for a
+    screening or None if it has no seat map.
+    """
+    c.execute("""SELECT seat_layout, seat_statuses FROM seat_maps
+                 INNER JOIN seat_layouts ON seat_layouts.seat_layout_id = seat_maps.seat_layout_id
+                 WHERE screening_id = ?""",
+              (screening_id,))
+    data = c.fetchone()
+    if data is None:
+        return None
+    return unpack_seats(json.loads(data[0]), data[1])
+
+def from_db_get_seat_states(screening_id):
+    """
+    Returns a dict of seat_location to seat_status as of a screening's latest seat sample.
+    """
+    c.execute("""SELECT seat_location, seat_status FROM seat_changes
+                 INNER JOIN seat_samples ON seat_samples.sample_id = seat_changes.sample_id
+                 WHERE screening_id = ? ORDER BY seat_samples.sample_id""",
+              (screening_id,))
+    return {location: SEAT_STATUSES[status] for location, status in c.fetchall()}
+
+def insert_seat_sample(screening_id, seat_rows, sampled_at=None, screening_url=None):
+    """
+    Records a sample of a screening's seats, storing only seats that changed since its last sample.
+
+    Returns the number of seats that changed.  Raises ValueError for a status not in
+    SEAT_STATUSES before anything is written.
+    """
+    sampled_at = sampled_at or datetime.datetime.now().isoformat(timespec='seconds')
+    statuses = [(location, SEAT_STATUSES.index(status)) for location, seat_type, status in seat_rows]
+    screening_capacity = sum(1 for location, status in statuses
+                             if status != SEAT_STATUSES.index('unavailableSeat'))
+    seats_sold = sum(1 for location, status in statuses
+                     if status == SEAT_STATUSES.index('reservedSeat'))
+    try:
+        with metrics.timer('write', screening_url), conn:
+            previous = from_db_get_seat_states(screening_id)
+            changes = [(location, status) for location, status in statuses
+                       if previous.get(location) != SEAT_STATUSES[status]]
+            c.execute("""INSERT INTO seat_samples(screening_id, sampled_at, screening_capacity, seats_sold)
+                         VALUES (?,?,?,?)""",
+                      (screening_id, sampled_at, screening_capacity, seats_sold))
+            sample_id = c.lastrowid
+            c.executemany("""INSERT INTO seat_changes(sample_id, seat_location, seat_status)
+                             VALUES (?,?,?)
+                             ON CONFLICT(sample_id, seat_location) DO NOTHING""",
+                          [(sample_id, location, status) for location, status in changes])
+            metrics.count('rows', 1 + c.rowcount)
+    except sqlite3.IntegrityError:
+        print("Error inserting seat sample")
+        return 0
+    return len(changes)
+
+def from_db_get_sales_curve(screening_id):
+    """
+    Returns (sampled_at, seats_sold) for every seat sample of a screening, oldest first.
+    """
+    c.execute("""SELECT sampled_at, seats_sold FROM seat_samples
+                 WHERE screening_id = ? ORDER BY sample_id""",
+              (screening_id,))
+    return c.fetchall()
+
+def from_db_get_page_version(page_url):
+    """
+    Returns (content_hash, etag, last_modified) recorded for a page or None.
+    """
+    c.execute("SELECT content_hash, etag, last_modified FROM page_versions WHERE page_url = ?",
+              (page_url,))
+    return c.fetchone()
+
+def update_page_version(page_url, version):
+    """
+    Records the (content_hash, etag, last_modified) of a page that has been processed.
+    """
+    try:
+        with conn:
+            c.execute("""INSERT INTO page_versions(page_url, content_hash, etag, last_modified)
+                         VALUES (?,?,?,?)
+                         ON CONFLICT(page_url) DO UPDATE SET content_hash = excluded.content_hash,
+                                                             etag = excluded.etag,
+                                                             last_modified = excluded.last_modified""",
+                      (page_url,) + tuple(version))
+    except sqlite3.IntegrityError:
+        print("Could not record version of %s" % page_url)
+
 def from_db_get_theater_id(theater_url):
     """
     Returns the theater_id from theaters table using a theater's url.
     """
+    theater_id = id_cache.get('theaters', theater_url)
+    if theater_id is not None:
+        return theater_id
     try:
         with conn:
             c.execute("SELECT theater_id FROM theaters WHERE theater_url = ?", (theater_url,))
-            return c.fetchone()[0]
+            theater_id = c.fetchone()[0]
+            id_cache.add('theaters', theater_url, theater_id)
+            return theater_id
     except sqlite3.IntegrityError:
         print("Error retrieving theater_id")
 
@@ -260,11 +989,16 @@ def from_db_get_screening_id(screening_url):
     """
     Returns screening_id from screening table using a screening's url.
     """
+    screening_id = id_cache.get('screenings', screening_url)
+    if screening_id is not None:
+        return screening_id
     try:
         with conn:
             c.execute("""SELECT screening_id FROM screenings
                          WHERE screening_url = ?""", (screening_url,))
-            return c.fetchone()[0]
+            screening_id = c.fetchone()[0]
+            id_cache.add('screenings', screening_url, screening_id)
+            return screening_id
     except sqlite3.IntegrityError:
         print("Error retrieving screening_id")
 
@@ -283,10 +1017,15 @@ def from_db_get_movie_id(movie_title):
     """
     Returns movie_id from movies table using a movie's title.
     """
+    movie_id = id_cache.get('movies', movie_title)
+    if movie_id is not None:
+        return movie_id
     try:
         with conn:
             c.execute("SELECT movie_id FROM movies WHERE movie_title = ?", (movie_title,))
-            return c.fetchone()[0]
+            movie_id = c.fetchone()[0]
+            id_cache.add('movies', movie_title, movie_id)
+            return movie_id
     except sqlite3.IntegrityError:
         print("Error retrieving movie_id")
 
@@ -294,22 +1033,29 @@ def from_db_get_movie_location_id(movie_id, theater_id):
     """
     Returns movie_location_id from movie_locations table using a movie's id and a theater's id
     """
+    movie_location_id = id_cache.get('movie_locations', (movie_id, theater_id))
+    if movie_location_id is not None:
+        return movie_location_id
     try:
         with conn:
             c.execute("""SELECT movie_location_id FROM movie_locations
                          WHERE movie_id = ? AND theater_id = ?""",
                       (movie_id, theater_id))
-            return c.fetchone()[0]
+            movie_location_id = c.fetchone()[0]
+            id_cache.add('movie_locations', (movie_id, theater_id), movie_location_id)
+            return movie_location_id
     except sqlite3.IntegrityError:
         print("Error retrieving movie_location_id")
 
 def from_db_get_daily_screenings(today):
     """
-    Returns all showtimes scheduled for today at every theater.
+    Returns all showtimes scheduled for today at every theater, earliest first.
     """
     try:
         with conn:
-            c.execute("SELECT screening_id, screening_url FROM screenings WHERE screening_date = ?",
+            c.execute("""SELECT screening_id, screening_url, screening_time
+                         FROM screenings WHERE screening_date = ?
+                         ORDER BY screening_time ASC""",
                       (today,))
             return c.fetchall()
     except sqlite3.IntegrityError:
@@ -340,6 +1086,77 @@ def update_screening_auditorium(screening_id, screening_auditorium):
     except sqlite3.IntegrityError:
         print("Could not update auditorium in screening")
 
+def screening_capacity_sold(screening_id):
+    """
+    Returns screening_capacity, screening_seats_sold and screening_estimated_earnings for a
+    screening from its seats and its most expensive ticket.  Estimated earnings are None if the
+    screening has no ticket prices yet.
+
+    Seats are counted from the latest seat sample when the screening has been sampled, or
+    straight from the packed statuses when the screening has a seat map.
+    """
+    c.execute("""SELECT screening_capacity, seats_sold FROM seat_samples
+                 WHERE screening_id = ? ORDER BY sample_id DESC LIMIT 1""",
+              (screening_id,))
+    seat_sample = c.fetchone()
+    c.execute("SELECT seat_statuses FROM seat_maps WHERE screening_id = ?", (screening_id,))
+    seat_map = c.fetchone()
+    if seat_sample is not None:
+        screening_capacity, screening_seats_sold = seat_sample
+    elif seat_map is not None:
+        statuses = seat_map[0]
+        screening_capacity = len(statuses) - statuses.count(SEAT_STATUSES.index('unavailableSeat'))
+        screening_seats_sold = statuses.count(SEAT_STATUSES.index('reservedSeat'))
+    else:
+        c.execute("""SELECT count(*) FROM seats
+                     WHERE screening_id = ? AND NOT seat_status = 'unavailableSeat'""",
+                  (screening_id,))
+        screening_capacity = c.fetchone()[0]
+
+        c.execute("""SELECT count(*) FROM seats
+                     WHERE screening_id = ? AND seat_status='reservedSeat'""",
+                  (screening_id,))
+        screening_seats_sold = c.fetchone()[0]
+
+    c.execute("""SELECT ticket_price FROM tickets
+                 WHERE screening_id = ? ORDER BY ticket_price DESC""",
+              (screening_id,))
+    ticket_price = c.fetchone()
+    if ticket_price is None:
+        return screening_capacity, screening_seats_sold, None
+
+    screening_estimated_earnings = screening_seats_sold*ticket_price[0]
+    return screening_capacity, screening_seats_sold, screening_estimated_earnings
+
+def set_screening_capacity_sold(screening_id):
+    """
+    Stores the values from screening_capacity_sold and returns the change in the screening's
+    estimated earnings.  Must be called inside a transaction that already holds the write lock,
+    see update_earnings.
+
+    Earnings are left as they are, and 0 returned, while the screening has no ticket prices.
+    """
+    c.execute("SELECT screening_estimated_earnings FROM screenings WHERE screening_id = ?",
+              (screening_id,))
+    previous_earnings = c.fetchone()[0] or 0
+
+    screening_capacity, screening_seats_sold, screening_estimated_earnings = \
+        screening_capacity_sold(screening_id)
+    if screening_estimated_earnings is None:
+        c.execute("""UPDATE screenings SET screening_capacity = ?, screening_seats_sold = ?
+                     WHERE screening_id = ?""",
+                  (screening_capacity, screening_seats_sold, screening_id))
+        return 0
+
+    c.execute("""UPDATE screenings
+                 SET screening_capacity = ?,
+                     screening_seats_sold = ?,
+                     screening_estimated_earnings = ?
+                WHERE screening_id = ?""",
+              (screening_capacity, screening_seats_sold, screening_estimated_earnings,
+               screening_id))
+    return screening_estimated_earnings - previous_earnings
+
 def update_screening_capacity_sold(screening_id):
     """
     Updates screening_capacity, screening_seats_sold and screening_estimated_earnings columns
@@ -347,114 +1164,690 @@ def update_screening_capacity_sold(screening_id):
     """
     try:
         with conn:
-            c.execute("""SELECT count(*) FROM seats
-                         WHERE screening_id = ? AND NOT seat_status = 'unavailableSeat'""",
-                      (screening_id,))
-            screening_capacity = c.fetchone()[0]
-
-            c.execute("""SELECT count(*) FROM seats
-                         WHERE screening_id = ? AND seat_status='reservedSeat'""",
-                      (screening_id,))
-            screening_seats_sold = c.fetchone()[0]
-
-            c.execute("""SELECT ticket_price FROM tickets
-                         WHERE screening_id = ? ORDER BY ticket_price DESC""",
-                      (screening_id,))
-            ticket_price = c.fetchone()[0]
-
-            screening_estimated_earnings = screening_seats_sold*ticket_price
-
-            c.execute("""UPDATE screenings
-                         SET screening_capacity = ?,
-                             screening_seats_sold = ?,
-                             screening_estimated_earnings = ?
-                        WHERE screening_id = ?""",
-                      (screening_capacity, screening_seats_sold, screening_estimated_earnings,
-                       screening_id))
+            set_screening_capacity_sold(screening_id)
     except sqlite3.IntegrityError:
         print("Could not update seat information in screening")
 
-def update_movie_location_earnings(screening_id):
+def add_earnings(screening_id, earnings):
+    """
+    Adds earnings to the totals of the movie at a theater, the movie and the theater that a
+    screening belongs to.  Must be called inside a transaction.
+    """
+    c.execute("""SELECT movie_locations.movie_location_id, movie_id, theater_id FROM screenings
+                 INNER JOIN movie_locations
+                 ON movie_locations.movie_location_id = screenings.movie_location_id
+                 AND screening_id = ?""",
+              (screening_id,))
+    movie_location_id, movie_id, theater_id = c.fetchone()
+
+    c.execute("""UPDATE movie_locations SET estimated_earnings = IFNULL(estimated_earnings, 0) + ?
+                 WHERE movie_location_id = ?""",
+              (earnings, movie_location_id))
+    c.execute("""UPDATE movies SET movie_estimated_earnings = IFNULL(movie_estimated_earnings, 0) + ?
+                 WHERE movie_id = ?""",
+              (earnings, movie_id))
+    c.execute("""UPDATE theaters SET theater_estimated_earnings = IFNULL(theater_estimated_earnings, 0) + ?
+                 WHERE theater_id = ?""",
+              (earnings, theater_id))
+
+def update_earnings(screening_id, screening_url=None):
     """
-    Updates estimated earnings for a movie at a specified theater.
+    Updates earnings totals for a screening, movie at a theater, movie and theter.
+
+    Runs after getting seat data for a screening.  Only the change in the screening's estimated
+    earnings is added to the other totals, all in one transaction.  rebuild_earnings recomputes
+    the totals from scratch.
     """
     try:
-        with conn:
-            c.execute("SELECT movie_location_id FROM screenings WHERE screening_id = ?",
-                      (screening_id,))
-            movie_location_id = c.fetchone()[0]
-            c.execute("""SELECT SUM(screening_estimated_earnings) FROM screenings
-                         WHERE movie_location_id = ?""",
-                      (movie_location_id,))
-            movie_location_earnings = c.fetchone()[0]
-            c.execute("""UPDATE movie_locations SET estimated_earnings = ?
-                         WHERE movie_location_id = ?""",
-                      (movie_location_earnings, movie_location_id))
+        with metrics.timer('rollup', screening_url), conn:
+            #Lock before reading the previous earnings so two processes can't both add the change
+            if not conn.in_transaction:
+                c.execute("BEGIN IMMEDIATE")
+            earnings = set_screening_capacity_sold(screening_id)
+            if earnings:
+                add_earnings(screening_id, earnings)
     except sqlite3.IntegrityError:
-        print("Could not update earnings for movie at this theater")
+        print("Could not update earnings for screening %s" % screening_id)
 
-def update_movie_earnings(screening_id):
+def rebuild_earnings():
     """
-    Updates estimated earnings for a movie from all theaters.
+    Recomputes estimated earnings of every movie at a theater, movie and theater from the
+    screenings table in one transaction.
     """
     try:
         with conn:
-            c.execute("""SELECT movie_locations.movie_id FROM screenings
-                         INNER JOIN movie_locations
-                         ON movie_locations.movie_location_id = screenings.movie_location_id
-                         AND screening_id = ?""",
-                      (screening_id,))
-            movie_id = c.fetchone()[0]
-            c.execute("SELECT SUM(estimated_earnings) FROM movie_locations WHERE movie_id = ?",
-                      (movie_id,))
-            movie_earnings = c.fetchone()[0]
-
-            c.execute("UPDATE movies SET movie_estimated_earnings = ? WHERE movie_id = ?",
-                      (movie_earnings, movie_id))
+            c.execute("""UPDATE movie_locations SET estimated_earnings =
+                             (SELECT SUM(screening_estimated_earnings) FROM screenings
+                              WHERE screenings.movie_location_id = movie_locations.movie_location_id)""")
+            c.execute("""UPDATE movies SET movie_estimated_earnings =
+                             (SELECT SUM(estimated_earnings) FROM movie_locations
+                              WHERE movie_locations.movie_id = movies.movie_id)""")
+            c.execute("""UPDATE theaters SET theater_estimated_earnings =
+                             (SELECT SUM(estimated_earnings) FROM movie_locations
+                              WHERE movie_locations.theater_id = theaters.theater_id)""")
     except sqlite3.IntegrityError:
-        print("Could not update earnings for movie")
+        print("Could not rebuild earnings")
 
-def update_theater_earnings(screening_id):
+def headless_firefox():
     """
-    Updates estimated earnings for a theater with a sum of all earnings from movies playing
-    at specified theater.
+    Starts a Firefox session without a visible window.
     """
-    try:
-        with conn:
-            c.execute("""SELECT movie_locations.theater_id FROM screenings
-                         INNER JOIN movie_locations
-                         ON movie_locations.movie_location_id = screenings.movie_location_id
-                         AND screening_id = ?""",
-                      (screening_id,))
-            theater_id = c.fetchone()[0]
-            c.execute("SELECT SUM(estimated_earnings) FROM movie_locations WHERE theater_id = ?",
-                      (theater_id,))
-            movie_earnings = c.fetchone()[0]
+    from selenium import webdriver
+    options = webdriver.FirefoxOptions()
+    options.add_argument('-headless')
+    browser = webdriver.Firefox(options=options)
+    browser.set_page_load_timeout(PAGE_TIMEOUT)
+    return browser
 
-            c.execute("UPDATE theaters SET theater_estimated_earnings = ? WHERE theater_id = ?",
-                      (movie_earnings, theater_id))
-    except sqlite3.IntegrityError:
-        print("Could not update earnings for theater")
+class BrowserPool:
+    """
+    Keeps browser sessions open so pages can be loaded without launching a new browser each time.
+
+    At most size sessions are handed out at once.  A session is checked before it is reused and is
+    replaced when it no longer responds or after it has loaded max_pages pages.
+    """
+    def __init__(self, size=BROWSER_POOL_SIZE, max_pages=BROWSER_MAX_PAGES, factory=headless_firefox):
+        self.size = size
+        self.max_pages = max_pages
+        self.factory = factory
+        self.idle = []
+        self.pages = {}
+        self.lock = threading.Lock()
+        self.available = threading.BoundedSemaphore(size)
+
+    def healthy(self, browser):
+        """
+        Returns True if the browser session still responds to commands.
+        """
+        from selenium.common.exceptions import WebDriverException
+        try:
+            browser.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    def discard(self, browser):
+        """
+        Closes a browser session that should not be reused.
+        """
+        from selenium.common.exceptions import WebDriverException
+        self.pages.pop(id(browser), None)
+        try:
+            browser.quit()
+        except WebDriverException:
+            pass
+
+    def acquire(self):
+        """
+        Returns an idle healthy session or starts a new one if none are left.
+        """
+        self.available.acquire()
+        try:
+            while True:
+                with self.lock:
+                    browser = self.idle.pop() if self.idle else None
+                if browser is None:
+                    browser = self.factory()
+                    self.pages[id(browser)] = 0
+                    return browser
+                if self.healthy(browser):
+                    return browser
+                self.discard(browser)
+        except Exception:
+            self.available.release()
+            raise
+
+    def release(self, browser):
+        """
+        Returns a session to the pool, recycling it once it has loaded max_pages pages.
+        """
+        self.pages[id(browser)] = self.pages.get(id(browser), 0) + 1
+        if self.pages[id(browser)] >= self.max_pages:
+            self.discard(browser)
+        else:
+            with self.lock:
+                self.idle.append(browser)
+        self.available.release()
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Lends a browser session for the duration of a with block.
+        """
+        browser = self.acquire()
+        try:
+            yield browser
+        finally:
+            self.release(browser)
+
+    def close(self):
+        """
+        Quits every idle session.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for browser in idle:
+            self.discard(browser)
+
+browser_pool = BrowserPool()
+
+class DomainRateLimiter:
+    """
+    Spaces out page requests made to the same host.
+
+    interval is the minimum number of seconds between two requests to one host.  Hosts listed in
+    host_intervals use their own interval instead.
+    """
+    def __init__(self, interval=DOMAIN_REQUEST_INTERVAL, host_intervals=None):
+        self.interval = interval
+        self.host_intervals = host_intervals or {}
+        self.next_request = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        """
+        Blocks until a request to the host of url is allowed.
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        interval = self.host_intervals.get(host, self.interval)
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request.get(host, now))
+            self.next_request[host] = start + interval
+        if start > now:
+            time.sleep(start - now)
+
+rate_limiter = DomainRateLimiter()
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of requesting a page from a host that has been failing.
+    """
+
+class HostCircuitBreaker:
+    """
+    Stops requests to a host after it has failed failures times in a row.
+
+    Requests to the host raise CircuitOpenError for cooldown seconds, then one request is let
+    through.  If it succeeds the host is used normally again, otherwise it waits another cooldown.
+    """
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN, clock=time.monotonic):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failed = collections.Counter()
+        self.open_until = {}
+        self.lock = threading.Lock()
+
+    def check(self, url):
+        """
+        Raises CircuitOpenError if requests to the host of url are stopped.
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            open_until = self.open_until.get(host)
+            if open_until is None:
+                return
+            if self.clock() < open_until:
+                raise CircuitOpenError('Not requesting %s, %s has been failing' % (url, host))
+            #Let this request through and hold back others until it finishes or fails
+            self.open_until[host] = self.clock() + self.cooldown
+
+    def success(self, url):
+        """
+        Records a successful request to the host of url.
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            self.failed.pop(host, None)
+            self.open_until.pop(host, None)
+
+    def failure(self, url):
+        """
+        Records a failed request to the host of url.
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            self.failed[host] += 1
+            if self.failed[host] >= self.failures:
+                self.open_until[host] = self.clock() + self.cooldown
+
+circuit_breaker = HostCircuitBreaker()
+
+def backoff_delay(attempt, base=FETCH_BACKOFF, cap=FETCH_BACKOFF_MAX):
+    """
+    Returns seconds to wait before retry number attempt + 1, a random time up to base * 2**attempt
+    seconds capped at cap, so clients that failed together don't all retry together.
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+def transport_error(error):
+    """
+    Returns True if error means the site could not be reached or was too slow, a connection or
+    timeout error or an HTTP 5xx status, rather than a problem with the page itself.
+    """
+    if hasattr(error, 'status'):
+        return error.status >= 500
+    if isinstance(error, OSError):
+        return True
+    if type(error).__module__.startswith('urllib3'):
+        import urllib3
+        if isinstance(error, urllib3.exceptions.MaxRetryError):
+            return isinstance(error.reason, (urllib3.exceptions.TimeoutError,
+                                             urllib3.exceptions.ProtocolError))
+        return isinstance(error, (urllib3.exceptions.TimeoutError, urllib3.exceptions.ProtocolError))
+    if type(error).__module__.startswith('selenium'):
+        from selenium.common.exceptions import TimeoutException
+        #Firefox shows an about:neterror page when it can't connect
+        return isinstance(error, TimeoutException) or 'about:neterror' in str(error)
+    return False
+
+def retry_fetch(url, fetch, *args):
+    """
+    Returns fetch(*args), a request for url, trying again up to FETCH_RETRIES times after
+    backoff_delay seconds if it raises a transport_error.
+
+    Requests are rate limited and go through circuit_breaker, which only counts transport errors.
+    Other errors, like a missing page or an element missing from the page, are raised straight
+    away.
+    """
+    for attempt in range(FETCH_RETRIES + 1):
+        circuit_breaker.check(url)
+        rate_limiter.wait(url)
+        try:
+            with metrics.timer('fetch', url):
+                result = fetch(*args)
+        except Exception as error:
+            if not transport_error(error):
+                raise
+            circuit_breaker.failure(url)
+            metrics.count('fetch_errors')
+            if attempt == FETCH_RETRIES:
+                raise
+            delay = backoff_delay(attempt, FETCH_BACKOFF, FETCH_BACKOFF_MAX)
+            print('Fetching %s failed, retrying in %.1fs: %s' % (url, delay, error))
+            time.sleep(delay)
+        else:
+            circuit_breaker.success(url)
+            return result
 
-def update_earnings(screening_id):
+def open_page(browser, url, ready):
     """
-    Updates earnings totals for a screening, movie at a theater, movie and theter.
+    Loads url and waits until an element matching the CSS selector ready is on the page.
 
-    Runs after getting seat data for a screening.
+    If the element never appears the page is left as is so the parser can decide what to do.
     """
-    update_screening_capacity_sold(screening_id)
-    update_movie_location_earnings(screening_id)
-    update_movie_earnings(screening_id)
-    update_theater_earnings(screening_id)
+    from selenium.webdriver.common.by import By
+    browser.get(url)
+    wait_for(browser, By.CSS_SELECTOR, ready)
 
-def open_browser(url):
+def wait_for(browser, by, selector):
     """
-    Waits 3 seconds for page to load before performing actions
+    Waits up to PAGE_TIMEOUT seconds for an element to be present on the current page.
     """
-    browser = webdriver.Firefox()
-    browser.get(url)
-    time.sleep(3)
-    return browser
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.support import expected_conditions
+    from selenium.webdriver.support.ui import WebDriverWait
+    try:
+        WebDriverWait(browser, PAGE_TIMEOUT).until(
+            expected_conditions.presence_of_element_located((by, selector)))
+    except TimeoutException:
+        print('Timed out waiting for %s on %s' % (selector, browser.current_url))
+
+@functools.lru_cache(maxsize=None)
+def get_http_pool():
+    """
+    Returns the keep-alive connection pool used by the http backend, creating it on first use.
+
+    Redirects are followed but failed requests are not retried here, retry_fetch does that.
+    """
+    import urllib3
+    retries = urllib3.Retry(total=None, connect=0, read=0, status=0, other=0, redirect=5)
+    return urllib3.PoolManager(maxsize=HTTP_POOL_SIZE, block=True, retries=retries,
+                               timeout=urllib3.Timeout(total=PAGE_TIMEOUT),
+                               headers={'Accept-Encoding': 'gzip, deflate',
+                                        'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:115.0) '
+                                                      'Gecko/20100101 Firefox/115.0'})
+
+def browser_fetch(url, ready):
+    """
+    Returns the page source of url after loading it in a pooled browser session.
+    """
+    with browser_pool.session() as browser:
+        open_page(browser, url, ready)
+        return browser.page_source
+
+def http_fetch(url, ready):
+    """
+    Returns the page source of url using a keep-alive HTTP connection pool.
+
+    Responses are requested gzip compressed and decompressed by urllib3.  ready is ignored since
+    the whole document is downloaded before it is returned.
+    """
+    return http_request(url).data.decode('utf-8', 'replace')
+
+def http_request(url, headers=None):
+    """
+    Returns the urllib3 response for url, raising HTTPError for an error status.
+
+    headers are sent in addition to the pool's default headers.
+    """
+    import urllib3
+    http_pool = get_http_pool()
+    response = http_pool.request('GET', url, headers=dict(http_pool.headers, **(headers or {})))
+    if response.status >= 400:
+        error = urllib3.exceptions.HTTPError('%s returned status %s' % (url, response.status))
+        error.status = response.status
+        raise error
+    return response
+
+class SnapshotStore:
+    """
+    Keeps gzip compressed copies of fetched pages on disk so they can be parsed again later.
+
+    Pages are stored once per distinct content, named by the SHA-256 of the page.  An index in
+    snapshots.db records which url and kind of page ('page' or 'seats') was fetched when.  Once
+    the pages take up more than max_bytes the oldest fetches are forgotten and pages no fetch
+    refers to any more are deleted.
+    """
+    def __init__(self, directory, max_bytes=SNAPSHOT_MAX_MB * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.index = sqlite3.connect(os.path.join(directory, 'snapshots.db'),
+                                     check_same_thread=False)
+        with self.index:
+            self.index.execute("""CREATE TABLE IF NOT EXISTS pages(
+                                      content_hash TEXT,
+                                      page_bytes INTEGER,
+                                      PRIMARY KEY(content_hash))""")
+            self.index.execute("""CREATE TABLE IF NOT EXISTS fetches(
+                                      fetch_id INTEGER,
+                                      url TEXT NOT NULL,
+                                      kind TEXT NOT NULL,
+                                      fetched_at TEXT NOT NULL,
+                                      content_hash TEXT NOT NULL,
+                                      PRIMARY KEY(fetch_id),
+                                      FOREIGN KEY(content_hash) REFERENCES pages(content_hash))""")
+            self.index.execute("""CREATE INDEX IF NOT EXISTS fetches_url
+                                      ON fetches(url, kind, fetched_at)""")
+        self.total_bytes = self.index.execute("SELECT IFNULL(SUM(page_bytes), 0) FROM pages").fetchone()[0]
+
+    def path(self, content_hash):
+        """
+        Returns the file a page with content_hash is stored in.
+        """
+        return os.path.join(self.directory, content_hash[:2], content_hash + '.html.gz')
+
+    def save(self, url, kind, page_source, fetched_at=None):
+        """
+        Stores a fetched page.
+        """
+        data = page_source.encode('utf-8')
+        content_hash = hashlib.sha256(data).hexdigest()
+        fetched_at = fetched_at or datetime.datetime.now().isoformat(timespec='seconds')
+        with self.lock:
+            path = self.path(content_hash)
+            with self.index:
+                self.index.execute("""INSERT INTO fetches(url, kind, fetched_at, content_hash)
+                                      VALUES (?,?,?,?)""",
+                                   (url, kind, fetched_at, content_hash))
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    compressed = gzip.compress(data)
+                    with open(path, 'wb') as page:
+                        page.write(compressed)
+                    self.index.execute("""INSERT INTO pages(content_hash, page_bytes) VALUES (?, ?)
+                                          ON CONFLICT(content_hash) DO NOTHING""",
+                                       (content_hash, len(compressed)))
+                    self.total_bytes += len(compressed)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def load(self, url, kind, before=None):
+        """
+        Returns the newest stored page for url fetched before the ISO timestamp before, or None.
+        """
+        with self.lock:
+            data = self.index.execute("""SELECT content_hash FROM fetches
+                                         WHERE url = ? AND kind = ? AND fetched_at <= ?
+                                         ORDER BY fetched_at DESC, fetch_id DESC LIMIT 1""",
+                                      (url, kind, before or '9999')).fetchone()
+        if data is None:
+            return None
+        with gzip.open(self.path(data[0]), 'rb') as page:
+            return page.read().decode('utf-8')
+
+    def evict(self):
+        """
+        Forgets the oldest fetches until the stored pages fit in max_bytes.  Must hold lock.
+        """
+        with self.index:
+            while self.total_bytes > self.max_bytes:
+                oldest = self.index.execute("""SELECT fetch_id, content_hash FROM fetches
+                                               ORDER BY fetched_at, fetch_id LIMIT 1""").fetchone()
+                if oldest is None:
+                    break
+                fetch_id, content_hash = oldest
+                self.index.execute("DELETE FROM fetches WHERE fetch_id = ?", (fetch_id,))
+                if self.index.execute("SELECT 1 FROM fetches WHERE content_hash = ?",
+                                      (content_hash,)).fetchone() is None:
+                    page_bytes = self.index.execute("SELECT page_bytes FROM pages WHERE content_hash = ?",
+                                                    (content_hash,)).fetchone()[0]
+                    self.index.execute("DELETE FROM pages WHERE content_hash = ?", (content_hash,))
+                    os.remove(self.path(content_hash))
+                    self.total_bytes -= page_bytes
+
+    def close(self):
+        """
+        Closes the index database.
+        """
+        self.index.close()
+
+snapshot_store = None
+
+def replay_fetch(url, ready):
+    """
+    Returns the newest snapshot of url instead of downloading it.
+    """
+    page_source = snapshot_store.load(url, 'page')
+    if page_source is None:
+        raise LookupError('No snapshot of %s' % url)
+    return page_source
+
+FETCH_BACKENDS = {'browser': browser_fetch, 'http': http_fetch, 'replay': replay_fetch}
+fetch_backend = 'browser'
+seat_storage = 'rows'
+refetch_unchanged = False
+
+def fetch_page(url, ready):
+    """
+    Returns the page source of a page that can be read without clicking anything.
+
+    Uses the backend named by fetch_backend.  ready is the CSS selector of an element the caller
+    needs, for backends that have to wait for a page to render.  Downloaded pages are kept in
+    snapshot_store when it is set.
+    """
+    if fetch_backend == 'replay':
+        return replay_fetch(url, ready)
+    page_source = retry_fetch(url, FETCH_BACKENDS[fetch_backend], url, ready)
+    if snapshot_store is not None:
+        snapshot_store.save(url, 'page', page_source)
+    return page_source
+
+def fetch_if_changed(url, version, fetch):
+    """
+    Returns (page_source, version) for url, with page_source None if the page has not changed
+    since version was recorded.
+
+    version is the (content_hash, etag, last_modified) tuple from from_db_get_page_version or
+    None.  The http backend asks the server whether the page changed using the ETag and
+    Last-Modified headers.  Otherwise the page is downloaded with fetch and its hash compared.
+    """
+    etag = last_modified = None
+    if fetch_backend == 'http':
+        headers = {}
+        if version is not None and version[1]:
+            headers['If-None-Match'] = version[1]
+        if version is not None and version[2]:
+            headers['If-Modified-Since'] = version[2]
+        response = retry_fetch(url, http_request, url, headers)
+        if response.status == 304:
+            return None, version
+        page_source = response.data.decode('utf-8', 'replace')
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if snapshot_store is not None:
+            snapshot_store.save(url, 'page', page_source)
+    else:
+        page_source = fetch(url)
+
+    content_hash = hashlib.sha256(page_source.encode('utf-8')).hexdigest()
+    if version is not None and version[0] == content_hash:
+        return None, version
+    return page_source, (content_hash, etag, last_modified)
+
+#Process pool set by -parse_processes that parse_page hands pages to
+parse_pool = None
+parse_processes = 0
+
+def parse_page(parse, page_source):
+    """
+    Returns parse(page_source), run in parse_pool when one is set.
+
+    parse must be a module level function returning plain tuples and lists, so only the page and
+    the result travel between processes.
+    """
+    if parse_pool is None:
+        return parse(page_source)
+    return parse_pool.submit(parse, page_source).result()
+
+class Pipeline:
+    """
+    Fetches, parses and writes a list of items with each stage running at the same time.
+
+    fetch(item) runs on workers threads and parse(item, fetched) on parsers threads, one per
+    parse_processes by default, connected by queues holding at most queue_size items.
+    write(item, parsed) runs on the calling thread, in the same order as items, so database writes
+    stay on the thread that owns the connection.  At most workers + parsers + 2 * queue_size items
+    are between fetching and writing at once, so fetching waits when writing falls behind.
+
+    If a stage raises for an item, on_error(item, error) is called on the calling thread in place
+    of write and the pipeline carries on.  Without on_error no new items are fetched and the error
+    is raised once the items already fetched have been written.
+
+    The stages time themselves in metrics.  The pipeline adds a 'pipeline' sample for the whole
+    run, tagged with name, and counts items fetched, parsed and written as name_fetched,
+    name_parsed and name_written.  name_fetched_queue_full and name_parsed_queue_full count how
+    often a stage had to wait because the next one fell behind.
+    """
+    def __init__(self, fetch, parse, write, workers=1, queue_size=PIPELINE_QUEUE_SIZE, parsers=None,
+                 on_error=None, name='pipeline'):
+        self.fetch = fetch
+        self.parse = parse
+        self.write = write
+        self.on_error = on_error
+        self.workers = workers
+        self.parsers = parsers or max(1, parse_processes)
+        self.queue_size = queue_size
+        self.name = name
+        self.lock = threading.Lock()
+
+    def put(self, stage_queue, stage, entry):
+        """
+        Adds entry to stage_queue, counting the item towards stage and whether it had to wait.
+        """
+        metrics.count('%s_%s' % (self.name, stage))
+        try:
+            stage_queue.put_nowait(entry)
+        except queue.Full:
+            metrics.count('%s_%s_queue_full' % (self.name, stage))
+            stage_queue.put(entry)
+
+    def run(self, items):
+        """
+        Runs every item through the pipeline.
+        """
+        with metrics.timer('pipeline', self.name):
+            self.run_stages(items)
+
+    def run_stages(self, items):
+        """
+        Starts the fetch and parse threads and writes their results, see run.
+        """
+        items = enumerate(items)
+        fetched = queue.Queue(self.queue_size)
+        parsed = queue.Queue(self.queue_size)
+        in_flight = threading.Semaphore(self.workers + self.parsers + 2 * self.queue_size)
+        stopped = threading.Event()
+        done = object()
+        running = {'fetch': self.workers, 'parse': self.parsers}
+
+        def finish(stage, next_queue, count):
+            #The last thread of a stage to finish tells count threads of the next stage to stop
+            with self.lock:
+                running[stage] -= 1
+                last = running[stage] == 0
+            if last:
+                for thread in range(count):
+                    next_queue.put(done)
+
+        def fetch_items():
+            while True:
+                in_flight.acquire()
+                with self.lock:
+                    index, item = next(items, (None, None)) if not stopped.is_set() else (None, None)
+                if index is None:
+                    in_flight.release()
+                    finish('fetch', fetched, self.parsers)
+                    return
+                try:
+                    result = self.fetch(item), None
+                except Exception as error:
+                    result = None, error
+                self.put(fetched, 'fetched', (index, item) + result)
+
+        def parse_items():
+            for entry in iter(fetched.get, done):
+                index, item, page, error = entry
+                if error is None:
+                    try:
+                        page = self.parse(item, page)
+                    except Exception as parse_error:
+                        error = parse_error
+                self.put(parsed, 'parsed', (index, item, page, error))
+            finish('parse', parsed, 1)
+
+        threads = [threading.Thread(target=fetch_items, daemon=True) for worker in range(self.workers)]
+        threads += [threading.Thread(target=parse_items, daemon=True) for parser in range(self.parsers)]
+        for thread in threads:
+            thread.start()
+
+        waiting = {}
+        next_index = 0
+        first_error = None
+        for entry in iter(parsed.get, done):
+            waiting[entry[0]] = entry
+            while next_index in waiting:
+                index, item, result, error = waiting.pop(next_index)
+                next_index += 1
+                if error is None and first_error is None:
+                    try:
+                        self.write(item, result)
+                        metrics.count('%s_written' % self.name)
+                    except Exception as write_error:
+                        error = write_error
+                if error is not None and self.on_error is not None:
+                    self.on_error(item, error)
+                elif error is not None and first_error is None:
+                    first_error = error
+                    stopped.set()
+                in_flight.release()
+        for thread in threads:
+            thread.join()
+        if first_error is not None:
+            raise first_error
 
 def get_time_date(showtime_url):
     """
@@ -464,56 +1857,124 @@ def get_time_date(showtime_url):
     date, time = date_time[0].split('+')
     return date, time
 
+def has_class(name):
+    """
+    Returns an XPath predicate matching elements with name in their class attribute.
+    """
+    return 'contains(concat(" ", normalize-space(@class), " "), " %s ")' % name
+
+#Listed in the order get_amenity checks them
+SCREENING_TYPES = ('RealD 3D', 'Cinemark XD', 'Alternative Content', 'IMAX', 'D-Box', 'The Met Opera')
+
+MOVIES_XPATH = '//li[%s]' % has_class('fd-movie')
+TITLE_XPATH = './/a[%s]' % has_class('dark')
+VARIANTS_XPATH = './/li[%s]' % has_class('fd-movie__showtimes-variant')
+AMENITIES_XPATH = './/a/@data-amenity-name'
+SHOWTIME_URLS_XPATH = './/a[%s]/@href' % has_class('showtime-btn--available')
+
+ERROR_XPATH = '//section[%s]' % has_class('errorMessages')
+ERROR_MESSAGE_XPATH = '//div[%s]' % has_class('errorHeaderMessage')
+AUDITORIUM_XPATH = '//h2[@id="auditoriumInfo"]'
+TICKET_TABLE_XPATH = '(//table[%s])[1]' % has_class('quantityTable')
+TICKET_ROWS_XPATH = TICKET_TABLE_XPATH + '//tr'
+PRICE_DESC_XPATH = './/input[@name="pricedesc"]/@value'
+PRICE_XPATH = './/input[@name="price"]/@value'
+
+SEATS_XPATH = '//div[@id="svg-Layer_1"]//div'
+
+@functools.lru_cache(maxsize=None)
+def xpath(expression):
+    """
+    Returns expression compiled by lxml.  Each expression is only compiled once.
+    """
+    from lxml import etree
+    return etree.XPath(expression)
+
+@functools.lru_cache(maxsize=None)
+def html_parser():
+    """
+    Returns the lxml parser used for every page.
+    """
+    from lxml import html as lxml_html
+    return lxml_html.HTMLParser(encoding='utf-8')
+
+def parse_html(page_source):
+    """
+    Returns the lxml root element of a page.
+    """
+    if isinstance(page_source, str):
+        page_source = page_source.encode('utf-8')
+    from lxml import html as lxml_html
+    return lxml_html.fromstring(page_source, parser=html_parser())
+
 def get_amenity(showtime_type):
     """
     Returns the screening format of a movie and whether or not there is reserved seating.
 
     <a data-amenity-name="Reserved seating"></a>
-    Function only gets called when a screening has reserved seating.
-    """
-    if showtime_type.find('a', {'data-amenity-name': 'RealD 3D'}):
-        show_type = 'RealD 3D'
-    elif showtime_type.find('a', {'data-amenity-name': 'Cinemark XD'}):
-        show_type = 'Cinemark XD'
-    elif showtime_type.find('a', {'data-amenity-name': 'Alternative Content'}):
-        show_type = 'Alternative Content'
-    elif showtime_type.find('a', {'data-amenity-name': 'IMAX'}):
-        show_type = 'IMAX'
-    elif showtime_type.find('a', {'data-amenity-name': 'D-Box'}):
-        show_type = 'D-Box'
-    elif showtime_type.find('a', {'data-amenity-name': 'The Met Opera'}):
-        show_type = 'The Met Opera'
-    else:
-        show_type = 'Standard'
+    showtime_type is the lxml element of a showtimes variant.
+    """
+    amenities = set(xpath(AMENITIES_XPATH)(showtime_type))
+    show_type = next((screening_type for screening_type in SCREENING_TYPES
+                      if screening_type in amenities), 'Standard')
 
-    if showtime_type.find('a', {'data-amenity-name': 'Reserved seating'}):
+    if 'Reserved seating' in amenities:
         reserved_seating = 'True'
     else:
         reserved_seating = 'False'
 
     return show_type, reserved_seating
 
-def movies(theater_url):
+def parse_theater_page(page_source):
     """
-    Yields the title of all movies playing at a theater.
+    Returns every movie playing at a theater as a list of (title, screenings) tuples where
+    screenings is a list of (screening_url, screening_type, reserved_seating) tuples.
 
     Loops through <li> elements with the following general structure:
-    
+
     <li class="fd-movie">
         <div class="fd-movie__details">
             <a class="dark">Movie Name</a>
         </div>
+        <ul class="fd-movie__showtimes">
+            <li class="fd-movie__showtimes-variant"> <!-- 3D, XD, Standard -->
+                <li class="fd-movie__amenity-icon-wrap>
+                    <a data-amenity-name="Reserved seating"></a>
+                </li>
+                <ol class="fd-movie__btn-list">
+                    <li class="fd-movie__btn-list-item">
+                    <a class="btn showtime-btn showtime-btn--available" href="ticketURL">time</a>
+                    </li>
+                </ol>
+            </li>
+        </ul>
     </li>
     """
-    browser = open_browser(theater_url)
-    soup = bs.BeautifulSoup(browser.page_source, 'lxml')
+    listing = []
 
-    movies_soup = soup.find_all('li', {'class': 'fd-movie'})
+    for movie in xpath(MOVIES_XPATH)(parse_html(page_source)):
+        title = xpath(TITLE_XPATH)(movie)[0].text_content()
+        screenings = []
 
-    for movie in movies_soup:
-        yield movie.find('a', {'class': 'dark'}).text
+        for variant in xpath(VARIANTS_XPATH)(movie):
+            screening_type, reserved_seating = get_amenity(variant)
+            for screening_url in xpath(SHOWTIME_URLS_XPATH)(variant):
+                screenings.append((screening_url, screening_type, reserved_seating))
+        listing.append((title, screenings))
+    return listing
+
+def fetch_theater_page(theater_url):
+    """
+    Returns the page source of a theater's showtime listing.
+    """
+    return fetch_page(theater_url, 'li.fd-movie')
 
-    browser.quit()
+def movies(theater_url):
+    """
+    Yields the title of all movies playing at a theater.
+    """
+    for title, screenings in parse_theater_page(fetch_theater_page(theater_url)):
+        yield title
 
 def get_movies(theater_url):
     """
@@ -527,43 +1988,13 @@ def get_movies(theater_url):
 
 def showtimes(theater_url):
     """
-    Loops through <li> elements with the following general structure:
-
-    <li class="fd-movie">
-        <div class="fd-movie__details">
-            <a class="dark">Movie Name</a>
-        </div>
-        <ul class="fd-movie__showtimes">
-            <li class="fd-movie__showtimes-variant"> <!-- 3D, XD, Standard -->
-                <li class="fd-movie__amenity-icon-wrap>
-                    <a data-amenity-name="Reserved seating"></a>
-                </li>
-                <ol class="fd-movie__btn-list">
-                    <li class="fd-movie__btn-list-item">
-                    <a class="btn showtime-btn showtime-btn--available" href="ticketURL">time</a>
-                    </li>
-                </ol>
-            </li>
-        </ul>
-    </li>
+    Yields screening url, movie_id, screening type and reserved seating for every showtime
+    at a theater.
     """
-    browser = open_browser(theater_url)
-    soup = bs.BeautifulSoup(browser.page_source, 'lxml')
-
-    movies_soup = soup.find_all('li', {'class': 'fd-movie'})
-
-    for movie in movies_soup:
-        title = movie.find('a', {'class': 'dark'}).text
+    for title, screenings in parse_theater_page(fetch_theater_page(theater_url)):
         movie_id = from_db_get_movie_id(title)
-        variants = movie.find_all('li', {'class': 'fd-movie__showtimes-variant'})
-
-        for variant in variants:
-            screening_type, reserved_seating = get_amenity(variant)
-            screenings = variant.find_all('a', {'class': 'showtime-btn--available'})
-
-            for screening in screenings:
-                yield screening['href'], movie_id, screening_type, reserved_seating
-    browser.quit()
+        for screening_url, screening_type, reserved_seating in screenings:
+            yield screening_url, movie_id, screening_type, reserved_seating
 
 def get_showtimes(theater_url):
     """
@@ -577,9 +2008,73 @@ def get_showtimes(theater_url):
         insert_screening(showtime[0], movie_location_id, screening_date_time,
                          showtime[2], showtime[3])
 
-def ticket_prices(screening_url):
+def get_theater(theater_url):
+    """
+    Adds movies, movie locations and showtimes at a theater to the database.
+
+    Does the work of get_movies and get_showtimes with one page load and one parse.  A page that
+    has not changed since it was last added is not parsed again unless refetch_unchanged is set.
     """
-    Parses table with the following general structure:
+    theater_id = from_db_get_theater_id(theater_url)
+    version = None if refetch_unchanged else from_db_get_page_version(theater_url)
+    page_source, version = fetch_if_changed(theater_url, version, fetch_theater_page)
+    if page_source is None:
+        print('Theater page has not changed: %s' % theater_url)
+        return
+    with metrics.timer('parse', theater_url, theater_url):
+        listing = parse_page(parse_theater_page, page_source)
+    insert_theater_listing(theater_id, listing, theater_url)
+    update_page_version(theater_url, version)
+
+def get_theaters(theater_urls, workers=1, today=None):
+    """
+    Does the work of get_theater for several theaters, fetching theater pages on workers threads
+    while earlier pages are parsed and written.  See Pipeline.
+
+    A theater whose page can't be fetched or parsed is queued as a job for today, for a -worker
+    to try again, instead of stopping the others.
+    """
+    today = today or datetime.date.today().isoformat()
+    theaters = [(theater_url, from_db_get_theater_id(theater_url),
+                 None if refetch_unchanged else from_db_get_page_version(theater_url))
+                for theater_url in theater_urls]
+
+    def fetch(theater):
+        return fetch_if_changed(theater[0], theater[2], fetch_theater_page)
+
+    def parse(theater, fetched):
+        page_source, version = fetched
+        if page_source is None:
+            return None
+        with metrics.timer('parse', theater[0], theater[0]):
+            return parse_page(parse_theater_page, page_source), version
+
+    def write(theater, parsed):
+        if parsed is None:
+            print('Theater page has not changed: %s' % theater[0])
+            return
+        insert_theater_listing(theater[1], parsed[0], theater[0])
+        update_page_version(theater[0], parsed[1])
+
+    def retry(theater, error):
+        print('Could not add theater %s, queued to try again: %s' % (theater[0], error))
+        enqueue_job('theater', theater[0], today, time.time() + JOB_RETRY_DELAY)
+
+    Pipeline(fetch, parse, write, workers, on_error=retry, name='theaters').run(theaters)
+
+def fetch_ticket_page(screening_url):
+    """
+    Returns the page source of a screening's ticket page.
+    """
+    return fetch_page(screening_url, 'table.quantityTable, section.errorMessages')
+
+def parse_ticket_prices(page_source):
+    """
+    Returns a list of (ticket_desc, ticket_price, auditorium) tuples from a ticket page or
+    a list holding the error message if the screening can no longer be booked.  Raises
+    ValueError if the page has neither, for example when it was saved before the table loaded.
+
+    The ticket table has the following general structure:
 
     <table class="section quantityTable">
         <tbody class="ticketTypeTable" id="Reserved">
@@ -598,43 +2093,43 @@ def ticket_prices(screening_url):
     </table>
     <h2 id="auditoriumInfo">Auditorium #</h2>
     """
-    browser = open_browser(screening_url)
-    soup = bs.BeautifulSoup(browser.page_source, 'lxml')
-    error = soup.find('section', {'class': 'errorMessages'})
-    
+    page = parse_html(page_source)
+
+    if xpath(ERROR_XPATH)(page):
+        return [xpath(ERROR_MESSAGE_XPATH)(page)[0].text_content()]
+    if not xpath(TICKET_TABLE_XPATH)(page):
+        raise ValueError('Ticket page has no ticket table or error message')
 
-    if error:
-        error_message = soup.find('div', {'class': 'errorHeaderMessage'}).text
-        browser.quit()
-        yield error_message
+    auditorium = xpath(AUDITORIUM_XPATH)(page)
+    if auditorium:
+        auditorium = auditorium[0].text_content()
     else:
-        #auditorium = soup.find('h2', {'id': 'auditoriumInfo'}).text
-        auditorium = soup.find('h2', {'id': 'auditoriumInfo'})
-        tickets_table = soup.find('table', {'class': 'quantityTable'})
-        tickets_rows = tickets_table.find_all('tr')
-        if auditorium is not None:   
-            for ticket_row in tickets_rows:
-                ticket_type = ticket_row.find('input', {'name': 'pricedesc'})
-                price = ticket_row.find('input', {'name': 'price'})
-                yield ticket_type['value'], price['value'], auditorium.text
-            browser.quit()
-        else:
-            for ticket_row in tickets_rows:
-                ticket_type = ticket_row.find('input', {'name': 'pricedesc'})
-                price = ticket_row.find('input', {'name': 'price'})
-                yield ticket_type['value'], price['value'], auditorium
-            browser.quit()
+        auditorium = None
+    prices = []
+    for ticket_row in xpath(TICKET_ROWS_XPATH)(page):
+        ticket_type = xpath(PRICE_DESC_XPATH)(ticket_row)
+        price = xpath(PRICE_XPATH)(ticket_row)
+        if ticket_type and price:
+            prices.append((ticket_type[0], price[0], auditorium))
+    return prices
 
-def get_ticket_prices(today):
+def ticket_prices(screening_url):
     """
-    Calls functions to get ticket prices and auditorium for each screening today.
+    Yields ticket prices and auditorium for a screening.  See parse_ticket_prices.
+    """
+    for ticket_price in parse_ticket_prices(fetch_ticket_page(screening_url)):
+        yield ticket_price
+
+def store_ticket_prices(screening_id, prices, screening_url=None):
+    """
+    Adds ticket prices for a screening to the database and records its auditorium.
+    screening_url only tags the write in metrics.
     """
-    showtimes_today = from_db_get_daily_screenings(today)
     e1 = '\n        This showtime is no longer available. Please select a different showtime.\n        '
+    auditorium = None
 
-    for showtime in showtimes_today:
-        screening_id = showtime[0]
-        for ticket_price in ticket_prices(showtime[1]):
+    with metrics.timer('write', screening_url):
+        for ticket_price in prices:
             if ticket_price == e1:
                 print('This showtime is no longer available')
                 auditorium = None
@@ -644,8 +2139,85 @@ def get_ticket_prices(today):
         if auditorium is not None:
             update_screening_auditorium(screening_id, auditorium)
 
-def seats(screening_url):
+def get_ticket_prices(today, workers=1, clock=datetime.datetime.now):
     """
+    Calls functions to get ticket prices and auditorium for each screening today.
+
+    Ticket pages are fetched earliest showtime first on workers threads while earlier pages are
+    parsed and written, see Pipeline.  Results are written in the same order whatever the number
+    of workers.  Ticket pages that have not changed since they were last stored are skipped.  When
+    fetching today's pages live, screenings that have started by the time their page would be
+    fetched are skipped too and counted as missed_deadlines in metrics.  Replayed pages and pages
+    for other days are always processed.  A screening whose page can't be fetched or parsed is queued as
+    a tickets job, for a -worker to try again before it starts.
+    """
+    showtimes_today = [(showtime, None if refetch_unchanged else from_db_get_page_version(showtime[1]))
+                       for showtime in from_db_get_daily_screenings(today)]
+    live = fetch_backend != 'replay' and clock().date().isoformat() == today
+
+    def fetch(showtime):
+        screening_url, version = showtime[0][1], showtime[1]
+        start = datetime.datetime.strptime('%s %s' % (today, showtime[0][2]), '%Y-%m-%d %H:%M')
+        if live and clock() > start:
+            metrics.count('missed_deadlines')
+            return None, version
+        return fetch_if_changed(screening_url, version, fetch_ticket_page)
+
+    def parse(showtime, fetched):
+        page_source, version = fetched
+        if page_source is None:
+            return None, version
+        with metrics.timer('parse', showtime[0][1]):
+            return parse_page(parse_ticket_prices, page_source), version
+
+    def write(showtime, parsed):
+        prices, version = parsed
+        if prices is not None:
+            store_ticket_prices(showtime[0][0], prices, showtime[0][1])
+            update_page_version(showtime[0][1], version)
+
+    def retry(showtime, error):
+        print('Could not add ticket prices for screening %s, queued to try again: %s'
+              % (showtime[0][0], error))
+        start = datetime.datetime.strptime('%s %s' % (today, showtime[0][2]), '%Y-%m-%d %H:%M')
+        enqueue_job('tickets', showtime[0][1], today, time.time() + JOB_RETRY_DELAY, start.timestamp())
+
+    Pipeline(fetch, parse, write, workers, on_error=retry, name='tickets').run(showtimes_today)
+
+def fetch_seat_page(screening_url):
+    """
+    Returns the page source of a screening's seating chart.
+
+    Always uses a browser since a ticket has to be selected before the seating chart is shown,
+    unless the page is being replayed from snapshot_store.
+    """
+    if fetch_backend == 'replay':
+        page_source = snapshot_store.load(screening_url, 'seats')
+        if page_source is None:
+            raise LookupError('No seating chart snapshot of %s' % screening_url)
+        return page_source
+
+    from selenium.webdriver.common.by import By
+    select_option = '//*[@id="AreaRepeater_TicketRepeater_0_quantityddl_0"]/option[2]'
+
+    def open_seat_chart():
+        with browser_pool.session() as browser:
+            browser.get(screening_url)
+            wait_for(browser, By.XPATH, select_option)
+            browser.find_element(By.XPATH, select_option).click()
+            browser.find_element(By.XPATH, '//*[@id="NewCustomerCheckoutButton"]').click()
+            wait_for(browser, By.CSS_SELECTOR, 'div#svg-Layer_1 > div')
+            return browser.page_source
+
+    page_source = retry_fetch(screening_url, open_seat_chart)
+    if snapshot_store is not None:
+        snapshot_store.save(screening_url, 'seats', page_source)
+    return page_source
+
+def parse_seat_chart(page_source):
+    """
+    Returns a list of (seat id, seat classes) tuples for every seat in a seating chart.
+
     Seating chart has the following general strucutre:
 
     <div id="svg-Layer_1">
@@ -655,44 +2227,115 @@ def seats(screening_url):
         <div class="wheelchair availableSeat" id="D11" data-seats="D11-58"></div>
     </div>
     """
-    browser = open_browser(screening_url)
-    select_option = '//*[@id="AreaRepeater_TicketRepeater_0_quantityddl_0"]/option[2]'
-    browser.find_element_by_xpath(select_option).click()
-    browser.find_element_by_xpath('//*[@id="NewCustomerCheckoutButton"]').click()
-    soup = bs.BeautifulSoup(browser.page_source, 'lxml')
-    seat_chart = soup.find('div', {'id': 'svg-Layer_1'})
-    seats_screening = seat_chart.find_all('div')
-    for seat in seats_screening:
-        #('H16', ['standard', 'availableSeat'], 'Auditorium 9')
-        yield seat['id'], seat['class']
-    browser.quit()
+    #('H16', ['standard', 'availableSeat'])
+    return [(seat.get('id'), seat.get('class', '').split())
+            for seat in xpath(SEATS_XPATH)(parse_html(page_source))]
+
+def seats(screening_url):
+    """
+    Yields the id and classes of every seat for a screening.  See parse_seat_chart.
+    """
+    for seat in parse_seat_chart(fetch_seat_page(screening_url)):
+        yield seat
+
+def seat_row(seat):
+    """
+    Returns (seat_location, seat_type, seat_status) for a seat yielded by seats().
+    """
+    if len(seat[1]) > 1:
+        return seat[0], seat[1][0], seat[1][1]
+    else: #If seat is not available
+        return seat[0], seat[1][0], seat[1][0]
+
+def parse_seat_rows(page_source):
+    """
+    Returns (seat_location, seat_type, seat_status) for every seat in a seating chart.
+    """
+    return [seat_row(seat) for seat in parse_seat_chart(page_source)]
+
+def fetch_seat_rows(screening_url):
+    """
+    Returns (seat_location, seat_type, seat_status) for every seat of a screening.
+    """
+    page_source = fetch_seat_page(screening_url)
+    with metrics.timer('parse', screening_url):
+        return parse_page(parse_seat_rows, page_source)
 
 def get_seat_data(screening_url):
     """
     Gathers seat data for a screening and updates earnings totals.
     """
-    screening_id = from_db_get_screening_id(screening_url)
-    for seat in seats(screening_url):
-        if len(seat[1]) > 1:
-            insert_seat(screening_id, seat[0], seat[1][0], seat[1][1])
-        else: #If seat is not available
-            insert_seat(screening_id, seat[0], seat[1][0], seat[1][0])
-        update_earnings(screening_id)
+    store_seat_data(from_db_get_screening_id(screening_url), fetch_seat_rows(screening_url),
+                    screening_url)
 
-def verify_showtime(seen, showtime):
+def store_seat_data(screening_id, seat_rows, screening_url=None):
     """
-    Ensures that scheduled tasks do not start at the same time.
+    Adds seat data for a screening to the database and updates earnings totals.
+
+    Seats are stored in one transaction and earnings are recomputed once the whole
+    seating chart has been written.  When seat_storage is 'packed' the chart is stored as a
+    single seat_maps row, unless it has a seat status that can't be packed.
     """
-    if showtime not in seen:
-        return showtime
+    if seat_storage == 'packed':
+        try:
+            insert_seat_map(screening_id, seat_rows, screening_url)
+        except ValueError as error:
+            print("Storing seats as rows, could not pack seat map: %s" % error)
+            insert_seats(screening_id, seat_rows, screening_url)
     else:
-        adjusted_time = showtime - datetime.timedelta(minutes=1)
-        return verify_showtime(seen, adjusted_time)
+        insert_seats(screening_id, seat_rows, screening_url)
+    update_earnings(screening_id, screening_url)
+
+def store_seat_sample(screening_id, seat_rows, screening_url=None):
+    """
+    Records a seat sample for a screening and updates earnings totals from it.
+
+    A chart with a seat status that can't be sampled is stored with store_seat_data instead.
+    """
+    try:
+        changed = insert_seat_sample(screening_id, seat_rows, screening_url=screening_url)
+    except ValueError as error:
+        print("Storing seats as rows, could not sample seats: %s" % error)
+        store_seat_data(screening_id, seat_rows, screening_url)
+        return
+    print('%s seats changed for screening %s' % (changed, screening_id))
+    update_earnings(screening_id, screening_url)
+
+def assign_check_times(showtimes, lead=SEAT_CHECK_LEAD, slot_capacity=1):
+    """
+    Returns a (check_time, minutes_moved) tuple for each showtime in showtimes.
+
+    A check ideally starts lead minutes before its showtime.  At most slot_capacity checks start
+    in the same minute, so when a minute is full the check is moved to the closest earlier minute
+    with room.  minutes_moved is how much earlier than ideal the check starts.
+
+    Checks are taken latest first from a heap.  The free minute being searched for only ever moves
+    earlier, so the total work is linear in the number of showtimes plus the minutes spanned.
+    """
+    minute = datetime.timedelta(minutes=1)
+    heap = [(-((showtime - datetime.datetime.min) // minute), index)
+            for index, showtime in enumerate(showtimes)]
+    heapq.heapify(heap)
+    assigned = [None] * len(showtimes)
+    used = collections.Counter()
+    cursor = None
+
+    while heap:
+        index = heapq.heappop(heap)[1]
+        ideal = showtimes[index] - lead * minute
+        if cursor is None or ideal < cursor:
+            cursor = ideal
+        while used[cursor] >= slot_capacity:
+            cursor -= minute
+        used[cursor] += 1
+        assigned[index] = (cursor, int((ideal - cursor) / minute))
+    return assigned
 
 def schedule_task(showtime_id, showtime_url, stime):
     """
     Schedules script to run using Schtasks in Windows PowerShell.
     """
+    import subprocess
     task_time = stime.replace(':', '-')
     tname = 'scrn ' + str(showtime_id) + ' at ' + task_time
     script_location = "D:\\box_office\\box_office.py"
@@ -703,24 +2346,304 @@ def schedule_task(showtime_id, showtime_url, stime):
     subprocess.call("""%s""" % task)
     print('Created task: ', tname)
 
-def queue_times(today):
+def queue_times(today, slot_capacity=1):
     """
     Gathers all showtimes with reserved seating and schedules script to run
     3 minutes before each screening starts.
+
+    No more than slot_capacity tasks start in the same minute.  Prints how many minutes early
+    each moved task runs.
     """
     showtimes_today = from_db_get_daily_reserved(today)
-    seen = set()
-
-    for showtime in showtimes_today:
-        showtime_start = showtime[2]
-        show_date = datetime.datetime.strptime('%s %s' % (today, showtime_start), '%Y-%m-%d %H:%M')
-        time_checkseats = show_date - datetime.timedelta(minutes=3)
-        verified_time = verify_showtime(seen, time_checkseats)
-        seen.add(verified_time)
-        verified_time_string = verified_time.strftime('%H:%M')
-        schedule_task(showtime[0], showtime[1], verified_time_string)
+    show_dates = [datetime.datetime.strptime('%s %s' % (today, showtime[2]), '%Y-%m-%d %H:%M')
+                  for showtime in showtimes_today]
+    check_times = assign_check_times(show_dates, slot_capacity=slot_capacity)
+
+    for showtime, (check_time, minutes_moved) in zip(showtimes_today, check_times):
+        if minutes_moved:
+            print('Seat check for screening %s moved %s minutes early' % (showtime[0], minutes_moved))
+        schedule_task(showtime[0], showtime[1], check_time.strftime('%H:%M'))
+
+    if check_times:
+        moved = [minutes_moved for check_time, minutes_moved in check_times]
+        print('Scheduled %s seat checks, moved at most %s minutes, %.1f minutes on average' %
+              (len(moved), max(moved), sum(moved) / len(moved)))
+
+def replay_seat_data(today, workers=1):
+    """
+    Gathers seat data for every reserved screening today that has a seating chart snapshot.
+
+    Charts are read and parsed while earlier ones are written, see Pipeline.
+    """
+    def fetch(screening):
+        try:
+            return fetch_seat_page(screening[1])
+        except LookupError:
+            print('No seating chart snapshot for screening %s' % screening[0])
+            return None
+
+    def parse(screening, page_source):
+        if page_source is None:
+            return None
+        with metrics.timer('parse', screening[1]):
+            return parse_page(parse_seat_rows, page_source)
+
+    def write(screening, seat_rows):
+        if seat_rows is not None:
+            store_seat_data(screening[0], seat_rows, screening[1])
+
+    def skip(screening, error):
+        print('Could not add seat data for screening %s: %s' % (screening[0], error))
+
+    Pipeline(fetch, parse, write, workers, on_error=skip, name='seats').run(
+        from_db_get_daily_reserved(today))
+
+def seat_check_jobs(today, lead=SEAT_CHECK_LEAD):
+    """
+    Returns a (check_time, showtime, screening_id, screening_url) job for every screening with
+    reserved seating today.  check_time is lead minutes before the showtime.
+    """
+    jobs = []
+    for screening_id, screening_url, screening_time in from_db_get_daily_reserved(today):
+        showtime = datetime.datetime.strptime('%s %s' % (today, screening_time), '%Y-%m-%d %H:%M')
+        jobs.append((showtime - datetime.timedelta(minutes=lead), showtime, screening_id,
+                     screening_url))
+    return jobs
+
+def seat_sample_jobs(today, offsets=SEAT_SAMPLE_OFFSETS, now=None):
+    """
+    Returns a (check_time, showtime, screening_id, screening_url) job for each of offsets minutes
+    before every screening with reserved seating from today until the largest offset from now.
+
+    Samples whose time has already passed are left out.
+    """
+    now = now or datetime.datetime.now()
+    first_day = datetime.date.fromisoformat(today)
+    jobs = []
+    for days in range(max(offsets) // 1440 + 1):
+        day = (first_day + datetime.timedelta(days=days)).isoformat()
+        for job in seat_check_jobs(day, 0):
+            showtime, screening_id, screening_url = job[1:]
+            for offset in offsets:
+                check_time = showtime - datetime.timedelta(minutes=offset)
+                if check_time >= now:
+                    jobs.append((check_time, showtime, screening_id, screening_url))
+    return jobs
+
+def run_scheduler(jobs, workers=1, fetch=fetch_seat_rows, clock=datetime.datetime.now,
+                  store=store_seat_data):
+    """
+    Runs seat checks in this process as they come due.
+
+    jobs is a list of (check_time, showtime, screening_id, screening_url) tuples.  Due checks are
+    fetched on a pool of workers threads, so checks with overlapping times wait for a free worker
+    instead of being moved earlier.  Seat data is written from the calling thread with
+    store(screening_id, seat_rows, screening_url), store_seat_sample to keep every sample instead
+    of the first.  Checks whose showtime has
+    already passed are skipped, and checks that fail are queued as seats jobs for a -worker.  A
+    check that can't be stored is reported and the scheduler carries on with the next one.
+    """
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+    heapq.heapify(jobs)
+    pending = {}
+
+    with ThreadPoolExecutor(workers) as executor:
+        while jobs or pending:
+            now = clock()
+            while jobs and jobs[0][0] <= now:
+                check_time, showtime, screening_id, screening_url = heapq.heappop(jobs)
+                if showtime < now:
+                    print('Skipping seat check for screening %s, it started at %s' %
+                          (screening_id, showtime.strftime('%H:%M')))
+                    metrics.count('missed_deadlines')
+                    continue
+                pending[executor.submit(fetch, screening_url)] = screening_id, showtime, screening_url
+
+            timeout = (jobs[0][0] - now).total_seconds() if jobs else None
+            if not pending:
+                if jobs:
+                    time.sleep(timeout)
+                continue
+
+            done, not_done = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                screening_id, showtime, screening_url = pending.pop(future)
+                try:
+                    seat_rows = future.result()
+                except Exception as error:
+                    print('Seat check failed for screening %s, queued to try again: %s'
+                          % (screening_id, error))
+                    enqueue_job('seats', screening_url, showtime.date().isoformat(),
+                                time.time() + JOB_RETRY_DELAY, showtime.timestamp())
+                    continue
+                try:
+                    store(screening_id, seat_rows, screening_url)
+                except Exception as error:
+                    print('Could not store seat check for screening %s: %s' % (screening_id, error))
+                    metrics.count('store_errors')
+                    continue
+                print('Checked seats for screening %s' % screening_id)
+
+def enqueue_job(job_type, job_key, job_date, available_at=None, deadline=None):
+    """
+    Adds a job to the work queue unless the same job has already been queued for job_date.
+
+    deadline is the unix time after which the job is no longer worth running.
+    """
+    try:
+        with conn:
+            c.execute("""INSERT INTO jobs(job_type, job_key, job_date, available_at, deadline)
+                         VALUES (?,?,?,?,?)
+                         ON CONFLICT(job_type, job_key, job_date) DO NOTHING""",
+                      (job_type, job_key, job_date, available_at or time.time(), deadline))
+    except sqlite3.IntegrityError:
+        print("Could not queue %s job for %s" % (job_type, job_key))
+
+def claim_job(worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Leases the next job that is due and returns (job_id, job_type, job_key, job_date) or None.
+
+    Jobs without a deadline come first, then the job with the earliest deadline.  A running job
+    whose lease has expired, because its worker died or stalled, is handed out again.  Jobs that
+    have been claimed JOB_MAX_ATTEMPTS times are marked failed instead, and jobs whose deadline has
+    passed are marked missed.
+    """
+    now = time.time()
+    with conn:
+        c.execute("""UPDATE jobs SET status = 'failed', last_error = 'lease expired'
+                     WHERE status = 'running' AND lease_expires < ? AND attempts >= ?""",
+                  (now, JOB_MAX_ATTEMPTS))
+        c.execute("""UPDATE jobs SET status = 'missed', lease_owner = NULL, lease_expires = NULL
+                     WHERE deadline < ?
+                     AND (status = 'pending' OR (status = 'running' AND lease_expires < ?))""",
+                  (now, now))
+        metrics.count('missed_deadlines', c.rowcount)
+        c.execute("""UPDATE jobs
+                     SET status = 'running', attempts = attempts + 1,
+                         lease_owner = ?, lease_expires = ?
+                     WHERE job_id = (SELECT job_id FROM jobs
+                                     WHERE (status = 'pending' AND available_at <= ?)
+                                        OR (status = 'running' AND lease_expires < ?)
+                                     ORDER BY deadline IS NOT NULL, deadline, available_at
+                                     LIMIT 1)
+                     RETURNING job_id, job_type, job_key, job_date""",
+                  (worker_id, now + lease_seconds, now, now))
+        return c.fetchone()
+
+def complete_job(job_id, worker_id):
+    """
+    Marks a job done.  Returns False if worker_id no longer holds the job's lease.
+    """
+    with conn:
+        c.execute("""UPDATE jobs SET status = 'done', lease_owner = NULL, lease_expires = NULL
+                     WHERE job_id = ? AND status = 'running' AND lease_owner = ?""",
+                  (job_id, worker_id))
+        return c.rowcount == 1
+
+def fail_job(job_id, worker_id, error):
+    """
+    Puts a job that raised an error back in the queue, or marks it failed once it has been tried
+    JOB_MAX_ATTEMPTS times.  The job waits at least JOB_RETRY_DELAY seconds before it is tried
+    again, plus a random backoff_delay that doubles with each attempt.
+    """
+    with conn:
+        c.execute("SELECT attempts FROM jobs WHERE job_id = ?", (job_id,))
+        delay = JOB_RETRY_DELAY + backoff_delay(c.fetchone()[0] - 1, JOB_RETRY_DELAY, JOB_RETRY_DELAY * 2**JOB_MAX_ATTEMPTS)
+        c.execute("""UPDATE jobs
+                     SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                         available_at = ?, lease_owner = NULL, lease_expires = NULL, last_error = ?
+                     WHERE job_id = ? AND status = 'running' AND lease_owner = ?""",
+                  (JOB_MAX_ATTEMPTS, time.time() + delay, str(error), job_id, worker_id))
+
+def print_job_status(path=DB_PATH):
+    """
+    Prints how many jobs have each status, reading the database at path without locking out
+    workers writing to it.
+    """
+    with contextlib.closing(connect(path, read_only=True)) as reader:
+        for status, jobs in reader.execute("SELECT status, count(*) FROM jobs GROUP BY status"):
+            print('%s: %s' % (status, jobs))
+
+def from_db_get_open_job_count():
+    """
+    Returns how many jobs are pending or running.
+    """
+    c.execute("SELECT count(*) FROM jobs WHERE status IN ('pending', 'running')")
+    return c.fetchone()[0]
+
+def run_theater_job(theater_url, job_date):
+    """
+    Adds a theater's movies and showtimes, then queues a tickets job for each of its screenings
+    on job_date.
+    """
+    get_theater(theater_url)
+    c.execute("""SELECT screening_url, screening_time FROM screenings
+                 INNER JOIN movie_locations
+                 ON movie_locations.movie_location_id = screenings.movie_location_id
+                 WHERE theater_id = ? AND screening_date = ?""",
+              (from_db_get_theater_id(theater_url), job_date))
+    for screening_url, screening_time in c.fetchall():
+        showtime = datetime.datetime.strptime('%s %s' % (job_date, screening_time), '%Y-%m-%d %H:%M')
+        enqueue_job('tickets', screening_url, job_date, deadline=showtime.timestamp())
+
+def run_tickets_job(screening_url, job_date):
+    """
+    Adds ticket prices for a screening and, if it has reserved seating, queues a seats job for
+    SEAT_CHECK_LEAD minutes before it starts.
+    """
+    screening_id = from_db_get_screening_id(screening_url)
+    version = None if refetch_unchanged else from_db_get_page_version(screening_url)
+    page_source, version = fetch_if_changed(screening_url, version, fetch_ticket_page)
+    if page_source is not None:
+        store_ticket_prices(screening_id, parse_page(parse_ticket_prices, page_source), screening_url)
+        update_page_version(screening_url, version)
+
+    c.execute("SELECT screening_time, reserved_seating FROM screenings WHERE screening_id = ?",
+              (screening_id,))
+    screening_time, reserved_seating = c.fetchone()
+    if reserved_seating == 'True':
+        showtime = datetime.datetime.strptime('%s %s' % (job_date, screening_time), '%Y-%m-%d %H:%M')
+        check_time = showtime - datetime.timedelta(minutes=SEAT_CHECK_LEAD)
+        enqueue_job('seats', screening_url, job_date, check_time.timestamp(), showtime.timestamp())
+
+def run_seats_job(screening_url, job_date):
+    """
+    Adds seat data for a screening.
+    """
+    get_seat_data(screening_url)
+
+JOB_HANDLERS = {'theater': run_theater_job, 'tickets': run_tickets_job, 'seats': run_seats_job}
+
+def run_worker(worker_id, lease_seconds=JOB_LEASE_SECONDS, idle_seconds=5):
+    """
+    Claims and runs jobs from the work queue until no job is pending or running.
+
+    Several workers, on this machine or others sharing the database, can run at once.  Writes
+    made by a job are idempotent, so a job run again after its worker died does not add any row
+    twice.
+    """
+    while True:
+        job = claim_job(worker_id, lease_seconds)
+        if job is None:
+            if not from_db_get_open_job_count():
+                return
+            time.sleep(idle_seconds)
+            continue
+
+        job_id, job_type, job_key, job_date = job
+        try:
+            JOB_HANDLERS[job_type](job_key, job_date)
+        except Exception as error:
+            print('%s job for %s failed: %s' % (job_type, job_key, error))
+            fail_job(job_id, worker_id, error)
+            continue
+        if not complete_job(job_id, worker_id):
+            print('Lease on %s job for %s expired before it finished' % (job_type, job_key))
 
 def main():
+    global browser_pool, rate_limiter, fetch_backend, seat_storage, snapshot_store
+    global refetch_unchanged, parse_pool, parse_processes
+
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-st', action='store_true', required=True)
@@ -740,26 +2663,108 @@ def main():
     parser.add_argument('-tickets', action='store_true',
                         help='Gathers ticket prices for each showtime today')
     parser.add_argument('-enque', action='store_true')
+    parser.add_argument('-slot_capacity', type=int, default=1,
+                        help='Seat check tasks that may be scheduled for the same minute.')
+    parser.add_argument('-daemon', action='store_true',
+                        help='Stays running and checks seats for every reserved showtime today.')
+    parser.add_argument('-lead', type=int, default=SEAT_CHECK_LEAD,
+                        help='Minutes before a showtime to check its seats with -daemon.')
+    parser.add_argument('-sample_offsets', type=int, nargs='*',
+                        help='With -daemon, samples seats at each of these minutes before a showtime '
+                             'and records the seats that changed.  Defaults to %s.'
+                             % ' '.join(map(str, SEAT_SAMPLE_OFFSETS)))
+
+    parser.add_argument('-queue_jobs', action='store_true',
+                        help='Queues a job for every theater today for -worker processes to run.')
+    parser.add_argument('-worker', action='store_true',
+                        help='Runs queued jobs until the queue is empty.')
+    parser.add_argument('-worker_id', type=str,
+                        help='Name this worker holds job leases under.  Defaults to host:pid.')
+    parser.add_argument('-lease', type=int, default=JOB_LEASE_SECONDS,
+                        help='Seconds a worker may hold a job before others can claim it.')
+    parser.add_argument('-job_status', action='store_true',
+                        help='Prints how many queued jobs are pending, running, done and failed.')
 
     parser.add_argument('-seats', type=str,
                         help='Gathers seat information for a showtime with a screening url.')
+    parser.add_argument('-rebuild-earnings', action='store_true',
+                        help='Recomputes earnings of every movie and theater from screenings.')
+
+    parser.add_argument('-browsers', type=int, default=BROWSER_POOL_SIZE,
+                        help='Number of browser sessions to keep open.')
+    parser.add_argument('-max_pages', type=int, default=BROWSER_MAX_PAGES,
+                        help='Pages a browser session loads before it is restarted.')
+    parser.add_argument('-workers', type=int, default=1,
+                        help='Number of pages or seat checks to fetch at the same time.')
+    parser.add_argument('-parse_processes', type=int, default=0,
+                        help='Number of processes to parse pages in.  0 parses in this process.')
+    parser.add_argument('-rate_limit', type=float, default=DOMAIN_REQUEST_INTERVAL,
+                        help='Minimum seconds between requests to the same site.')
+    parser.add_argument('-fetch', choices=['browser', 'http'], default=fetch_backend,
+                        help='How theater and ticket pages are downloaded.  Seat charts always use a browser.')
+    parser.add_argument('-seat_storage', choices=['rows', 'packed'], default=seat_storage,
+                        help='Store seats one row per seat or as one packed seat map per screening.')
+    parser.add_argument('-snapshot_dir', type=str, default=SNAPSHOT_DIR,
+                        help='Directory where copies of fetched pages are kept.')
+    parser.add_argument('-snapshot_mb', type=int, default=SNAPSHOT_MAX_MB,
+                        help='Megabytes of page copies to keep before the oldest are removed.')
+    parser.add_argument('-no_snapshots', action='store_true',
+                        help='Do not keep copies of fetched pages.')
+    parser.add_argument('-replay', action='store_true',
+                        help='Parse kept page copies instead of fetching pages.  '
+                             'With -auto, seats are read from copies instead of being scheduled.')
+    parser.add_argument('-force', action='store_true',
+                        help='Process theater and ticket pages even if they have not changed.')
+    parser.add_argument('-db', type=str, default=DB_PATH, help='Path of the sqlite3 database.')
+    parser.add_argument('-date', type=str,
+                        help='Day to gather screenings for as YYYY-MM-DD instead of today.')
+    parser.add_argument('-metrics_file', type=str,
+                        help='Writes stage timings and counters to this file, as Prometheus text '
+                             'if it ends in .prom or JSON lines otherwise.')
     args = parser.parse_args()
 
+    fetches_pages = (args.seats or args.auto or args.movies or args.showtimes or args.tickets
+                     or args.daemon or args.worker)
+    if fetches_pages and (args.replay or not args.no_snapshots):
+        snapshot_store = SnapshotStore(args.snapshot_dir, args.snapshot_mb * 2**20)
+
+    fetch_backend = 'replay' if args.replay else args.fetch
+    seat_storage = args.seat_storage
+    refetch_unchanged = args.force or args.replay
+    browser_pool = BrowserPool(max(args.browsers, args.workers), args.max_pages)
+    rate_limiter = DomainRateLimiter(args.rate_limit)
+    if args.parse_processes:
+        from concurrent.futures import ProcessPoolExecutor
+        parse_processes = args.parse_processes
+        parse_pool = ProcessPoolExecutor(parse_processes)
+
     if args.st:
+        use_database(args.db)
         create_tables()
+        if args.auto or args.movies or args.showtimes or args.worker:
+            #Only worth loading for commands that look up many theaters and movies
+            id_cache.warm()
         today = datetime.date.today()
-        today_string = today.isoformat()
+        today_string = args.date or today.isoformat()
         theater_urls = from_db_get_theater_urls()
 
     if args.seats:
-        get_seat_data(args.seats)
+        try:
+            get_seat_data(args.seats)
+        except Exception as error:
+            print('Seat check failed, queued to try again: %s' % error)
+            showtime = datetime.datetime.strptime(' '.join(get_time_date(args.seats)), '%Y-%m-%d %H:%M')
+            enqueue_job('seats', args.seats, showtime.date().isoformat(),
+                        time.time() + JOB_RETRY_DELAY, showtime.timestamp())
     elif args.auto:
-        for theater_url in theater_urls:
-            get_movies(theater_url[0])
-            get_showtimes(theater_url[0])
-            
-        get_ticket_prices(today_string)    
-        queue_times(today_string)
+        get_theaters([theater_url[0] for theater_url in theater_urls], args.workers)
+        if not args.replay:
+            #Scheduled before ticket prices so early seat checks aren't scheduled too late
+            queue_times(today_string, args.slot_capacity)
+        get_ticket_prices(today_string, args.workers)
+        if args.replay:
+            replay_seat_data(today_string, args.workers)
+        id_cache.report()
     elif args.insert_theater_name:
         if args.url_theater:
             insert_theater(args.insert_theater_name, args.url_theater)
@@ -767,7 +2772,22 @@ def main():
             print("Theater URL is required")
     elif args.enque:
         print('adding schedule')
-        queue_times(today_string)
+        queue_times(today_string, args.slot_capacity)
+    elif args.daemon and args.sample_offsets is not None:
+        run_scheduler(seat_sample_jobs(today_string, args.sample_offsets or SEAT_SAMPLE_OFFSETS),
+                      args.workers, store=store_seat_sample)
+    elif args.daemon:
+        run_scheduler(seat_check_jobs(today_string, args.lead), args.workers)
+    elif args.queue_jobs:
+        for theater_url in theater_urls:
+            enqueue_job('theater', theater_url[0], today_string)
+    elif args.worker:
+        if args.worker_id is None:
+            import socket
+            args.worker_id = '%s:%s' % (socket.gethostname(), os.getpid())
+        run_worker(args.worker_id, args.lease)
+    elif args.job_status:
+        print_job_status(args.db)
     elif args.movies:
         for theater_url in theater_urls:
             get_movies(theater_url[0])
@@ -775,7 +2795,19 @@ def main():
         for theater_url in theater_urls:
             get_showtimes(theater_url[0])
     elif args.tickets:
-        get_ticket_prices(today_string)
+        get_ticket_prices(today_string, args.workers)
+    elif args.rebuild_earnings:
+        rebuild_earnings()
+
+    browser_pool.close()
+    if parse_pool is not None:
+        parse_pool.shutdown()
+    if snapshot_store is not None:
+        snapshot_store.close()
+    if metrics.samples or metrics.counts:
+        metrics.report()
+    if args.metrics_file:
+        metrics.export(args.metrics_file)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
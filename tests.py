@@ -1,6 +1,33 @@
+import concurrent.futures
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+import urllib3
+from selenium.common.exceptions import TimeoutException, WebDriverException
 import box_office
 
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name)) as page:
+        return page.read()
+
+
+def use_memory_db():
+    box_office.conn = sqlite3.connect(':memory:')
+    box_office.c = box_office.conn.cursor()
+    box_office.id_cache = box_office.IdCache()
+    box_office.create_tables()
+
+
 class BoxOfficeTest(unittest.TestCase):
     def test_from_url_format_date(self):
         url = 'https://tickets.fandango.com/transaction/ticketing/express/ticketboxoffice.aspx?row_count=210902271&tid=AAVPA&sdate=2018-01-25+14:45&mid=202672&from=mov_det_showtimes'
@@ -9,3 +36,1029 @@ class BoxOfficeTest(unittest.TestCase):
     def test_from_url_format_time(self):
         url = 'https://tickets.fandango.com/transaction/ticketing/express/ticketboxoffice.aspx?row_count=210902271&tid=AAVPA&sdate=2018-01-25+14:45&mid=202672&from=mov_det_showtimes'
         assert box_office.get_time_date(url)[1] == '14:45'
+
+    def test_seat_row_unavailable(self):
+        assert box_office.seat_row(('A1', ['unavailableSeat'])) == ('A1', 'unavailableSeat', 'unavailableSeat')
+
+
+class SeatIngestionTest(unittest.TestCase):
+    def setUp(self):
+        use_memory_db()
+
+    def test_insert_seats_skips_existing(self):
+        box_office.insert_seat(1, 'A1', 'standard', 'reservedSeat')
+        box_office.insert_seats(1, [('A1', 'standard', 'availableSeat'),
+                                    ('A2', 'wheelchair', 'availableSeat'),
+                                    ('A2', 'wheelchair', 'reservedSeat')])
+        box_office.c.execute("SELECT seat_location, seat_status FROM seats ORDER BY seat_id")
+        assert box_office.c.fetchall() == [('A1', 'reservedSeat'), ('A2', 'availableSeat')]
+
+
+class FakeBrowser:
+    def __init__(self):
+        self.closed = False
+
+    @property
+    def current_url(self):
+        if self.closed:
+            raise WebDriverException('session deleted')
+        return 'about:blank'
+
+    def quit(self):
+        self.closed = True
+
+
+class BrowserPoolTest(unittest.TestCase):
+    def test_session_is_reused(self):
+        pool = box_office.BrowserPool(1, 10, FakeBrowser)
+        with pool.session() as first:
+            pass
+        with pool.session() as second:
+            pass
+        assert first is second
+
+    def test_session_recycled_after_max_pages(self):
+        pool = box_office.BrowserPool(1, 2, FakeBrowser)
+        with pool.session() as first:
+            pass
+        with pool.session():
+            pass
+        with pool.session() as third:
+            pass
+        assert first.closed and third is not first
+
+    def test_unhealthy_session_replaced(self):
+        pool = box_office.BrowserPool(1, 10, FakeBrowser)
+        with pool.session() as first:
+            pass
+        first.closed = True
+        with pool.session() as second:
+            pass
+        assert second is not first
+
+
+class TicketPricesTest(unittest.TestCase):
+    def setUp(self):
+        self.pages = {}
+        for screening in range(12):
+            url = 'https://tickets.example.com/ticketboxoffice.aspx?row_count=%s' % screening
+            self.pages[url] = fixture('tickets_error.html' if screening % 5 == 0 else 'tickets.html')
+        self.fetch_ticket_page = box_office.fetch_ticket_page
+        self.rate_limiter = box_office.rate_limiter
+        box_office.fetch_ticket_page = self.pages.get
+        box_office.rate_limiter = box_office.DomainRateLimiter(0)
+
+    def tearDown(self):
+        box_office.fetch_ticket_page = self.fetch_ticket_page
+        box_office.rate_limiter = self.rate_limiter
+
+    def collect(self, workers):
+        use_memory_db()
+        for url in self.pages:
+            box_office.insert_screening(url, 1, ['2018-01-25', '14:00'], 'Standard', 'True')
+        box_office.get_ticket_prices('2018-01-25', workers)
+        box_office.c.execute("SELECT * FROM tickets ORDER BY ticket_id")
+        tickets = box_office.c.fetchall()
+        box_office.c.execute("SELECT screening_id, screening_auditorium FROM screenings")
+        return tickets, box_office.c.fetchall()
+
+    def test_parse_ticket_prices_error(self):
+        assert box_office.parse_ticket_prices(fixture('tickets_error.html')) == [
+            '\n        This showtime is no longer available. Please select a different showtime.\n        ']
+
+    def test_parse_ticket_page_without_table(self):
+        with self.assertRaises(ValueError):
+            box_office.parse_ticket_prices('<html><body><h1>Loading</h1></body></html>')
+
+    def test_parse_ticket_prices(self):
+        assert box_office.parse_ticket_prices(fixture('tickets.html')) == [
+            ('Adult', '11.50', 'Auditorium 9'),
+            ('Child', '8.75', 'Auditorium 9'),
+            ('Senior', '9.25', 'Auditorium 9')]
+
+    def test_concurrent_matches_sequential(self):
+        sequential = self.collect(1)
+        assert len(sequential[0]) == 27
+        assert self.collect(4) == sequential
+
+    def test_process_pool_matches_in_process(self):
+        sequential = self.collect(1)
+        with concurrent.futures.ProcessPoolExecutor(2) as pool:
+            box_office.parse_pool, box_office.parse_processes = pool, 2
+            try:
+                assert self.collect(3) == sequential
+                for name, parse in (('theater.html', box_office.parse_theater_page),
+                                    ('seats.html', box_office.parse_seat_rows)):
+                    assert box_office.parse_page(parse, fixture(name)) == parse(fixture(name))
+            finally:
+                box_office.parse_pool, box_office.parse_processes = None, 0
+
+    def test_started_screenings_skipped_earliest_first(self):
+        use_memory_db()
+        box_office.metrics = box_office.Metrics()
+        for url, screening_time in zip(self.pages, ('19:00', '13:00', '11:00', '16:00')):
+            box_office.insert_screening(url, 1, ['2018-01-25', screening_time], 'Standard', 'True')
+        fetched = []
+        box_office.fetch_ticket_page = lambda url: fetched.append(url) or self.pages[url]
+        box_office.get_ticket_prices('2018-01-25', clock=lambda: box_office.datetime.datetime(2018, 1, 25, 12, 0))
+        urls = list(self.pages)
+        assert fetched == [urls[1], urls[3], urls[0]]
+        assert box_office.metrics.counts['missed_deadlines'] == 1
+
+    def test_unchanged_ticket_pages_skipped(self):
+        self.collect(1)
+        box_office.c.execute("DELETE FROM tickets")
+        box_office.get_ticket_prices('2018-01-25')
+        box_office.c.execute("SELECT count(*) FROM tickets")
+        assert box_office.c.fetchone()[0] == 0
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves files from the fixtures directory, gzip compressed when the client asks for it.
+    /moved/<name> redirects to <name>.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        if self.path.startswith('/moved/'):
+            self.send_response(301)
+            self.send_header('Location', self.path[len('/moved'):])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        path = os.path.join(FIXTURES, self.path.lstrip('/').split('?')[0])
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as page:
+            body = page.read()
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('ETag', etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpFetchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+        cls.server.connections = 0
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base_url = 'http://127.0.0.1:%s/' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.fetch_backend = box_office.fetch_backend
+        self.rate_limiter = box_office.rate_limiter
+        box_office.fetch_backend = 'http'
+        box_office.rate_limiter = box_office.DomainRateLimiter(0)
+
+    def tearDown(self):
+        box_office.fetch_backend = self.fetch_backend
+        box_office.rate_limiter = self.rate_limiter
+
+    def test_ticket_prices_over_http(self):
+        url = self.base_url + 'tickets.html?row_count=1'
+        assert list(box_office.ticket_prices(url)) == box_office.parse_ticket_prices(fixture('tickets.html'))
+
+    def test_movies_over_http(self):
+        titles = list(box_office.movies(self.base_url + 'theater.html'))
+        assert titles == ['The Shape of Water', 'Maze Runner: The Death Cure']
+
+    def test_connection_reused(self):
+        box_office.http_fetch(self.base_url + 'theater.html', None)
+        connections = self.server.connections
+        for page in range(3):
+            box_office.http_fetch(self.base_url + 'tickets.html', None)
+        assert self.server.connections == connections
+
+    def test_unchanged_page_not_downloaded(self):
+        url = self.base_url + 'theater.html'
+        page_source, version = box_office.fetch_if_changed(url, None, None)
+        assert version[1] is not None
+        assert box_office.fetch_if_changed(url, version, None) == (None, version)
+
+    def test_redirect_followed(self):
+        titles = list(box_office.movies(self.base_url + 'moved/theater.html'))
+        assert titles == ['The Shape of Water', 'Maze Runner: The Death Cure']
+
+    def test_missing_page_raises(self):
+        with self.assertRaises(urllib3.exceptions.HTTPError):
+            box_office.http_fetch(self.base_url + 'missing.html', None)
+
+
+class TheaterIngestionTest(unittest.TestCase):
+    theater_url = 'https://www.fandango.com/cinemark-tinseltown_aavpa/theater-page'
+
+    def setUp(self):
+        self.fetch_theater_page = box_office.fetch_theater_page
+        self.loads = 0
+
+        def fetch_theater_page(url):
+            self.loads += 1
+            return fixture('theater.html')
+        box_office.fetch_theater_page = fetch_theater_page
+
+    def tearDown(self):
+        box_office.fetch_theater_page = self.fetch_theater_page
+
+    def ingest(self, single_pass):
+        use_memory_db()
+        box_office.insert_theater('Cinemark Tinseltown', self.theater_url)
+        if single_pass:
+            box_office.get_theater(self.theater_url)
+        else:
+            box_office.get_movies(self.theater_url)
+            box_office.get_showtimes(self.theater_url)
+        rows = []
+        for table in ('movies', 'movie_locations', 'screenings'):
+            box_office.c.execute("SELECT * FROM %s ORDER BY 1" % table)
+            rows.append(box_office.c.fetchall())
+        return rows
+
+    def test_single_pass_matches_movies_then_showtimes(self):
+        separate = self.ingest(False)
+        self.loads = 0
+        combined = self.ingest(True)
+        assert combined == separate
+        assert self.loads == 1
+        assert len(combined[2]) == 4
+
+    def test_unchanged_page_skipped(self):
+        self.ingest(True)
+        box_office.c.execute("DELETE FROM screenings")
+        box_office.get_theater(self.theater_url)
+        box_office.c.execute("SELECT count(*) FROM screenings")
+        assert box_office.c.fetchone()[0] == 0
+
+        box_office.refetch_unchanged = True
+        try:
+            box_office.get_theater(self.theater_url)
+        finally:
+            box_office.refetch_unchanged = False
+        box_office.c.execute("SELECT count(*) FROM screenings")
+        assert box_office.c.fetchone()[0] == 4
+
+    def test_single_pass_is_repeatable(self):
+        first = self.ingest(True)
+        box_office.get_theater(self.theater_url)
+        box_office.c.execute("SELECT count(*) FROM screenings")
+        assert box_office.c.fetchone()[0] == len(first[2])
+
+
+class IdCacheTest(unittest.TestCase):
+    def setUp(self):
+        use_memory_db()
+        box_office.insert_theater('Cinemark Tinseltown', 'theater-url')
+        box_office.insert_movie('The Shape of Water')
+        box_office.insert_movie_location(1, 1)
+
+    def test_warm_cache_answers_lookups(self):
+        box_office.id_cache = box_office.IdCache()
+        box_office.id_cache.warm()
+        box_office.c.execute("DELETE FROM movies")
+        assert box_office.from_db_get_movie_id('The Shape of Water') == 1
+        assert box_office.from_db_get_theater_id('theater-url') == 1
+        assert box_office.from_db_get_movie_location_id(1, 1) == 1
+        assert box_office.id_cache.hit_rate() == 1.0
+
+    def test_lookup_after_insert_is_a_hit(self):
+        box_office.insert_screening('screening-url', 1, ['2018-01-25', '14:45'], 'Standard', 'True')
+        assert box_office.from_db_get_screening_id('screening-url') == 1
+        assert box_office.id_cache.hit_rate('screenings') == 1.0
+
+    def test_screenings_evicted_least_recently_used(self):
+        cache = box_office.IdCache(max_screenings=2)
+        cache.add('screenings', 'a', 1)
+        cache.add('screenings', 'b', 2)
+        cache.get('screenings', 'a')
+        cache.add('screenings', 'c', 3)
+        assert cache.get('screenings', 'b') is None
+        assert cache.get('screenings', 'a') == 1
+
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        box_office.conn = sqlite3.connect(':memory:')
+        box_office.c = box_office.conn.cursor()
+        box_office.id_cache = box_office.IdCache()
+        box_office.create_seats_table()
+        box_office.create_movie_locations_table()
+        box_office.create_screenings_table()
+        box_office.c.executemany("INSERT INTO seats(screening_id, seat_location) VALUES (?, ?)",
+                                 [(1, 'A1'), (1, 'A2'), (1, 'A1')])
+        box_office.c.executemany("INSERT INTO movie_locations(movie_id, theater_id) VALUES (?, ?)",
+                                 [(1, 1), (1, 1)])
+        box_office.c.execute("INSERT INTO screenings(screening_url, movie_location_id) VALUES ('url', 2)")
+        box_office.conn.commit()
+
+    def test_migration_removes_duplicates(self):
+        box_office.create_tables()
+        box_office.c.execute("SELECT seat_id FROM seats ORDER BY seat_id")
+        assert box_office.c.fetchall() == [(1,), (2,)]
+        box_office.c.execute("SELECT movie_location_id FROM screenings")
+        assert box_office.c.fetchall() == [(1,)]
+        box_office.c.execute("PRAGMA user_version")
+        assert box_office.c.fetchone()[0] == len(box_office.MIGRATIONS)
+
+    def test_migrations_run_once(self):
+        box_office.create_tables()
+        box_office.create_tables()
+        box_office.c.execute("PRAGMA user_version")
+        assert box_office.c.fetchone()[0] == len(box_office.MIGRATIONS)
+
+    def test_failed_migration_rolled_back(self):
+        def add_column_then_fail():
+            box_office.c.execute("ALTER TABLE seats ADD COLUMN seat_row TEXT")
+            raise sqlite3.OperationalError('interrupted')
+
+        box_office.create_tables()
+        self.addCleanup(setattr, box_office, 'MIGRATIONS', box_office.MIGRATIONS)
+        box_office.MIGRATIONS = box_office.MIGRATIONS + [add_column_then_fail]
+        with self.assertRaisesRegex(sqlite3.OperationalError, 'interrupted'):
+            box_office.migrate()
+        box_office.c.execute("PRAGMA user_version")
+        assert box_office.c.fetchone()[0] == len(box_office.MIGRATIONS) - 1
+        box_office.c.execute("SELECT name FROM pragma_table_info('seats') WHERE name = 'seat_row'")
+        assert box_office.c.fetchall() == []
+
+
+class EarningsTest(unittest.TestCase):
+    def setUp(self):
+        use_memory_db()
+        for theater in (1, 2):
+            box_office.insert_theater('Theater %s' % theater, 'theater-%s' % theater)
+        box_office.insert_movie('The Shape of Water')
+        box_office.insert_movie_location(1, 1)
+        box_office.insert_movie_location(1, 2)
+        for screening, movie_location_id in ((1, 1), (2, 1), (3, 2)):
+            box_office.insert_screening('screening-%s' % screening, movie_location_id,
+                                        ['2018-01-25', '14:45'], 'Standard', 'True')
+            box_office.insert_ticket(screening, 'Adult', 10)
+            box_office.insert_seats(screening, [('A1', 'standard', 'reservedSeat'),
+                                                ('A2', 'standard', 'reservedSeat'),
+                                                ('A3', 'standard', 'availableSeat'),
+                                                ('A4', 'unavailableSeat', 'unavailableSeat')])
+
+    def totals(self):
+        box_office.c.execute("""SELECT estimated_earnings FROM movie_locations
+                                UNION ALL SELECT movie_estimated_earnings FROM movies
+                                UNION ALL SELECT theater_estimated_earnings FROM theaters""")
+        return box_office.c.fetchall()
+
+    def test_incremental_matches_rebuild(self):
+        for screening in (1, 2, 3):
+            box_office.update_earnings(screening)
+        box_office.c.execute("UPDATE seats SET seat_status = 'reservedSeat' WHERE seat_location = 'A3'")
+        box_office.update_earnings(2)
+        box_office.update_earnings(2)
+        incremental = self.totals()
+        assert incremental == [(50,), (20,), (70,), (50,), (20,)]
+        box_office.rebuild_earnings()
+        assert self.totals() == incremental
+
+    def test_packed_seat_map_matches_rows(self):
+        box_office.update_earnings(1)
+        box_office.c.execute("SELECT * FROM screenings WHERE screening_id = 1")
+        rows = box_office.c.fetchone()
+
+        box_office.c.execute("SELECT seat_location, seat_type, seat_status FROM seats WHERE screening_id = 1")
+        seat_rows = box_office.c.fetchall()
+        box_office.c.execute("DELETE FROM seats")
+        box_office.insert_seat_map(1, seat_rows)
+        assert box_office.from_db_get_seat_map(1) == seat_rows
+        box_office.update_earnings(1)
+        box_office.c.execute("SELECT * FROM screenings WHERE screening_id = 1")
+        assert box_office.c.fetchone() == rows
+
+    def test_capacity_and_sold(self):
+        box_office.update_earnings(1)
+        box_office.c.execute("""SELECT screening_capacity, screening_seats_sold,
+                                       screening_estimated_earnings
+                                FROM screenings WHERE screening_id = 1""")
+        assert box_office.c.fetchone() == (3, 2, 20)
+
+
+class SeatMapTest(unittest.TestCase):
+    seat_rows = [('A1', 'unavailableSeat', 'unavailableSeat'),
+                 ('A2', 'standard', 'availableSeat'),
+                 ('B1', 'wheelchair', 'reservedSeat')]
+
+    def test_pack_round_trip(self):
+        layout, statuses = box_office.pack_seats(self.seat_rows)
+        assert statuses == bytes([2, 0, 1])
+        assert box_office.unpack_seats(layout, statuses) == self.seat_rows
+
+    def test_unknown_status_cannot_be_packed(self):
+        with self.assertRaises(ValueError):
+            box_office.pack_seats([('A1', 'standard', 'heldSeat')])
+
+    def test_screenings_share_layout(self):
+        use_memory_db()
+        box_office.insert_seat_map(1, self.seat_rows)
+        box_office.insert_seat_map(2, self.seat_rows[:2] + [('B1', 'wheelchair', 'availableSeat')])
+        box_office.insert_seat_map(2, self.seat_rows)
+        box_office.c.execute("SELECT count(*) FROM seat_layouts")
+        assert box_office.c.fetchone()[0] == 1
+        assert box_office.from_db_get_seat_map(2)[2] == ('B1', 'wheelchair', 'availableSeat')
+
+    def test_auditorium_layout_relearned(self):
+        use_memory_db()
+        box_office.insert_theater('Theater', 'theater-url')
+        box_office.insert_movie('The Shape of Water')
+        box_office.insert_movie_location(1, 1)
+        for screening in (1, 2, 3):
+            box_office.insert_screening('screening-%s' % screening, 1, ['2018-01-25', '14:45'],
+                                        'Standard', 'True')
+            box_office.update_screening_auditorium(screening, 'Auditorium 9')
+        box_office.insert_seat_map(1, self.seat_rows)
+        box_office.insert_seat_map(2, self.seat_rows)
+        box_office.insert_seat_map(3, self.seat_rows[1:])
+        box_office.c.execute("""SELECT screening_id, seat_layout_id FROM seat_maps
+                                UNION ALL SELECT screening_auditorium, seat_layout_id FROM auditorium_layouts""")
+        assert box_office.c.fetchall() == [(1, 1), (2, 1), (3, 2), ('Auditorium 9', 2)]
+        assert box_office.from_db_get_seat_map(3) == self.seat_rows[1:]
+
+    def test_seat_type_change_relearned(self):
+        use_memory_db()
+        box_office.insert_theater('Theater', 'theater-url')
+        box_office.insert_movie('The Shape of Water')
+        box_office.insert_movie_location(1, 1)
+        for screening in (1, 2):
+            box_office.insert_screening('screening-%s' % screening, 1, ['2018-01-25', '14:45'],
+                                        'Standard', 'True')
+            box_office.update_screening_auditorium(screening, 'Auditorium 9')
+        box_office.insert_seat_map(1, [('A1', 'unavailableSeat', 'unavailableSeat'),
+                                       ('A2', 'standard', 'availableSeat')])
+        changed = [('A1', 'wheelchair', 'availableSeat'), ('A2', 'companion', 'reservedSeat')]
+        box_office.insert_seat_map(2, changed)
+        assert box_office.from_db_get_seat_map(2) == changed
+
+    def test_known_layout_not_hashed(self):
+        use_memory_db()
+        box_office.insert_theater('Theater', 'theater-url')
+        box_office.insert_movie('The Shape of Water')
+        box_office.insert_movie_location(1, 1)
+        for screening in (1, 2, 3):
+            box_office.insert_screening('screening-%s' % screening, 1, ['2018-01-25', '14:45'],
+                                        'Standard', 'True')
+            box_office.update_screening_auditorium(screening, 'Auditorium 9')
+        box_office.insert_seat_map(1, self.seat_rows)
+        hashed = []
+        layout_fingerprint = box_office.layout_fingerprint
+        self.addCleanup(setattr, box_office, 'layout_fingerprint', layout_fingerprint)
+        box_office.layout_fingerprint = lambda layout: hashed.append(layout) or layout_fingerprint(layout)
+        box_office.insert_seat_map(2, self.seat_rows[:2] + [('B1', 'wheelchair', 'availableSeat')])
+        box_office.insert_seat_map(3, self.seat_rows)
+        assert hashed == []
+        assert box_office.id_cache.hits['auditorium_layouts'] == 1
+        box_office.c.execute("SELECT seat_layout_id FROM seat_maps")
+        assert box_office.c.fetchall() == [(1,), (1,), (1,)]
+        assert box_office.from_db_get_seat_map(2)[2] == ('B1', 'wheelchair', 'availableSeat')
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        use_memory_db()
+        box_office.insert_theater('Theater', 'theater-url')
+        box_office.insert_movie('The Shape of Water')
+        box_office.insert_movie_location(1, 1)
+        for screening in (1, 2, 3):
+            box_office.insert_screening('screening-%s' % screening, 1, ['2018-01-25', '14:45'],
+                                        'Standard', 'True')
+            box_office.insert_ticket(screening, 'Adult', 10)
+
+    def test_due_checks_run_and_passed_showtimes_skipped(self):
+        now = box_office.datetime.datetime.now()
+        minute = box_office.datetime.timedelta(minutes=1)
+        second = box_office.datetime.timedelta(seconds=0.2)
+        jobs = [(now + second, now + 3 * minute, 2, 'screening-2'),
+                (now - minute, now + 2 * minute, 1, 'screening-1'),
+                (now - 5 * minute, now - 2 * minute, 3, 'screening-3')]
+        fetched = []
+
+        def fetch(screening_url):
+            fetched.append(screening_url)
+            return [('A1', 'standard', 'reservedSeat'), ('A2', 'standard', 'availableSeat')]
+
+        box_office.run_scheduler(jobs, workers=2, fetch=fetch)
+        assert fetched == ['screening-1', 'screening-2']
+        box_office.c.execute("SELECT screening_id, screening_seats_sold FROM screenings ORDER BY 1")
+        assert box_office.c.fetchall() == [(1, 1), (2, 1), (3, None)]
+
+    def test_only_passed_showtimes(self):
+        now = box_office.datetime.datetime.now()
+        minute = box_office.datetime.timedelta(minutes=1)
+        jobs = [(now - 40 * minute, now - 30 * minute, 1, 'screening-1')]
+        box_office.run_scheduler(jobs, fetch=lambda url: self.fail('fetched %s' % url))
+        assert jobs == []
+
+    def test_seat_check_jobs(self):
+        box_office.c.execute("UPDATE screenings SET screening_time = '19:30' WHERE screening_id = 2")
+        jobs = box_office.seat_check_jobs('2018-01-25', lead=3)
+        assert [(job[0].strftime('%H:%M'), job[2]) for job in jobs] == [('14:42', 1), ('14:42', 3),
+                                                                        ('19:27', 2)]
+
+
+class CheckTimesTest(unittest.TestCase):
+    def showtimes(self, *times):
+        return [box_office.datetime.datetime(2018, 1, 25, *time) for time in times]
+
+    def test_collisions_move_earlier(self):
+        showtimes = self.showtimes((19, 0), (19, 0), (19, 0), (18, 58))
+        assigned = box_office.assign_check_times(showtimes, lead=3)
+        assert [(check.strftime('%H:%M'), moved) for check, moved in assigned] == [
+            ('18:57', 0), ('18:56', 1), ('18:55', 2), ('18:54', 1)]
+
+    def test_slot_capacity(self):
+        showtimes = self.showtimes((19, 0), (19, 0), (19, 0))
+        moved = [moved for check, moved in box_office.assign_check_times(showtimes, slot_capacity=2)]
+        assert sorted(moved) == [0, 0, 1]
+
+    def test_many_collisions_do_not_recurse(self):
+        showtimes = self.showtimes(*[(19, 0)] * 5000)
+        assigned = box_office.assign_check_times(showtimes)
+        assert max(moved for check, moved in assigned) == 4999
+
+
+class ParserTest(unittest.TestCase):
+    def test_parse_theater_page(self):
+        listing = box_office.parse_theater_page(fixture('theater.html'))
+        assert [title for title, screenings in listing] == ['The Shape of Water',
+                                                            'Maze Runner: The Death Cure']
+        assert [screening[1:] for screening in listing[1][1]] == [('Cinemark XD', 'True'),
+                                                                  ('Standard', 'False')]
+        assert listing[0][1][0][0] == ('https://tickets.fandango.com/transaction/ticketing/express/'
+                                       'ticketboxoffice.aspx?row_count=210902271&tid=AAVPA'
+                                       '&sdate=2018-01-25+14:45&mid=203988&from=mov_det_showtimes')
+
+    def test_amenity_priority(self):
+        variant = box_office.parse_html('<li><a data-amenity-name="IMAX"></a>'
+                                        '<a data-amenity-name="RealD 3D"></a></li>')
+        assert box_office.get_amenity(variant) == ('RealD 3D', 'False')
+
+    def test_parse_seat_chart(self):
+        chart = box_office.parse_seat_chart(fixture('seats.html'))
+        assert chart[:2] == [('A1', ['unavailableSeat']), ('A2', ['standard', 'availableSeat'])]
+        assert len(chart) == 8
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = box_office.SnapshotStore(self.directory.name)
+        self.fetch_backend = box_office.fetch_backend
+        self.snapshot_store = box_office.snapshot_store
+
+    def tearDown(self):
+        box_office.fetch_backend = self.fetch_backend
+        box_office.snapshot_store = self.snapshot_store
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_newest_snapshot_loaded(self):
+        self.store.save('url', 'page', 'first', '2018-01-25T09:00:00')
+        self.store.save('url', 'page', 'second', '2018-01-25T10:00:00')
+        self.store.save('url', 'seats', 'chart', '2018-01-25T11:00:00')
+        assert self.store.load('url', 'page') == 'second'
+        assert self.store.load('url', 'page', before='2018-01-25T09:30:00') == 'first'
+        assert self.store.load('url', 'seats') == 'chart'
+        assert self.store.load('other', 'page') is None
+
+    def test_identical_pages_stored_once(self):
+        self.store.save('url', 'page', fixture('theater.html'))
+        self.store.save('url', 'page', fixture('theater.html'))
+        pages = [name for folder, folders, names in os.walk(self.directory.name)
+                 for name in names if name.endswith('.html.gz')]
+        assert len(pages) == 1
+
+    def test_oldest_evicted(self):
+        self.store.max_bytes = 600
+        self.store.save('old', 'page', os.urandom(300).hex(), '2018-01-25T09:00:00')
+        self.store.save('new', 'page', os.urandom(300).hex(), '2018-01-25T10:00:00')
+        assert self.store.load('old', 'page') is None
+        assert self.store.load('new', 'page') is not None
+
+    def test_replay_without_browser(self):
+        theater_url = 'https://www.fandango.com/cinemark-tinseltown_aavpa/theater-page'
+        self.store.save(theater_url, 'page', fixture('theater.html'))
+        listing = box_office.parse_theater_page(fixture('theater.html'))
+        screening_url = listing[0][1][0][0]
+        self.store.save(screening_url, 'page', fixture('tickets.html'))
+        self.store.save(screening_url, 'seats', fixture('seats.html'))
+        box_office.snapshot_store = self.store
+        box_office.fetch_backend = 'replay'
+
+        use_memory_db()
+        box_office.insert_theater('Cinemark Tinseltown', theater_url)
+        box_office.get_theater(theater_url)
+        box_office.store_ticket_prices(1, box_office.ticket_prices(screening_url))
+        box_office.get_seat_data(screening_url)
+        box_office.c.execute("""SELECT screening_auditorium, screening_capacity, screening_seats_sold
+                                FROM screenings WHERE screening_id = 1""")
+        assert box_office.c.fetchone() == ('Auditorium 9', 7, 3)
+
+    def test_replay_past_day_ticket_prices(self):
+        theater_url = 'https://www.fandango.com/cinemark-tinseltown_aavpa/theater-page'
+        self.store.save(theater_url, 'page', fixture('theater.html'))
+        for movie in box_office.parse_theater_page(fixture('theater.html')):
+            for showtime in movie[1]:
+                self.store.save(showtime[0], 'page', fixture('tickets.html'))
+        box_office.snapshot_store = self.store
+        box_office.fetch_backend = 'replay'
+        box_office.metrics = box_office.Metrics()
+
+        use_memory_db()
+        box_office.insert_theater('Cinemark Tinseltown', theater_url)
+        box_office.get_theater(theater_url)
+        box_office.get_ticket_prices('2018-01-25')
+        box_office.c.execute("SELECT count(DISTINCT screening_id) FROM tickets")
+        assert box_office.c.fetchone()[0] == 4
+        assert 'missed_deadlines' not in box_office.metrics.counts
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        use_memory_db()
+        box_office.enqueue_job('theater', 'theater-url', '2018-01-25', time.time() - 1)
+
+    def test_enqueue_is_idempotent(self):
+        box_office.enqueue_job('theater', 'theater-url', '2018-01-25')
+        assert box_office.from_db_get_open_job_count() == 1
+
+    def test_claim_is_exclusive(self):
+        job = box_office.claim_job('a')
+        assert job[1:] == ('theater', 'theater-url', '2018-01-25')
+        assert box_office.claim_job('b') is None
+
+    def test_expired_lease_reclaimed(self):
+        job_id = box_office.claim_job('a', lease_seconds=-1)[0]
+        assert box_office.claim_job('b')[0] == job_id
+        assert not box_office.complete_job(job_id, 'a')
+        assert box_office.complete_job(job_id, 'b')
+        assert box_office.from_db_get_open_job_count() == 0
+
+    def test_failed_after_max_attempts(self):
+        box_office.JOB_RETRY_DELAY, retry_delay = 0, box_office.JOB_RETRY_DELAY
+        self.addCleanup(setattr, box_office, 'JOB_RETRY_DELAY', retry_delay)
+        for attempt in range(box_office.JOB_MAX_ATTEMPTS):
+            job_id = box_office.claim_job('a')[0]
+            box_office.fail_job(job_id, 'a', 'timed out')
+        assert box_office.claim_job('a') is None
+        box_office.c.execute("SELECT status, attempts, last_error FROM jobs")
+        assert box_office.c.fetchone() == ('failed', box_office.JOB_MAX_ATTEMPTS, 'timed out')
+
+    def test_retry_waits_at_least_retry_delay(self):
+        job_id = box_office.claim_job('a')[0]
+        before = time.time()
+        box_office.fail_job(job_id, 'a', 'timed out')
+        box_office.c.execute("SELECT status, available_at FROM jobs")
+        status, available_at = box_office.c.fetchone()
+        assert status == 'pending' and available_at >= before + box_office.JOB_RETRY_DELAY
+
+    def test_earliest_deadline_claimed_first_and_passed_missed(self):
+        box_office.metrics = box_office.Metrics()
+        now = time.time()
+        box_office.enqueue_job('tickets', 'late', '2018-01-25', now - 1, now + 600)
+        box_office.enqueue_job('tickets', 'early', '2018-01-25', now - 1, now + 60)
+        box_office.enqueue_job('tickets', 'started', '2018-01-25', now - 1, now - 60)
+        claimed = [box_office.claim_job('a')[2] for job in range(3)]
+        assert claimed == ['theater-url', 'early', 'late']
+        assert box_office.claim_job('a') is None
+        assert box_office.metrics.counts['missed_deadlines'] == 1
+
+    def test_worker_drains_queue(self):
+        ran = []
+        def theater(url, date):
+            ran.append(url)
+            box_office.enqueue_job('seats', 'screening-url', date, time.time() - 1)
+        handlers = box_office.JOB_HANDLERS
+        box_office.JOB_HANDLERS = {'theater': theater, 'seats': lambda url, date: ran.append(url)}
+        self.addCleanup(setattr, box_office, 'JOB_HANDLERS', handlers)
+        box_office.run_worker('a', idle_seconds=0)
+        assert ran == ['theater-url', 'screening-url']
+        assert box_office.from_db_get_open_job_count() == 0
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        use_memory_db()
+        box_office.metrics = box_office.Metrics()
+
+    def test_stages_recorded(self):
+        box_office.fetch_seat_page, fetch_seat_page = (lambda url: fixture('seats.html'),
+                                                       box_office.fetch_seat_page)
+        self.addCleanup(setattr, box_office, 'fetch_seat_page', fetch_seat_page)
+        box_office.insert_theater('Theater', 'theater-url')
+        box_office.insert_movie('The Shape of Water')
+        box_office.insert_movie_location(1, 1)
+        box_office.insert_screening('url', 1, ['2018-01-25', '19:00'], 'Standard', 'True')
+        box_office.insert_ticket(1, 'Adult', 11.5)
+        box_office.get_seat_data('url')
+        assert box_office.metrics.stages() == ['parse', 'write', 'rollup']
+        assert box_office.metrics.counts['rows'] == 9
+        assert box_office.metrics.samples[0][1] == 'url'
+        assert {(sample[0], sample[1]) for sample in box_office.metrics.samples[1:]} == {
+            ('write', 'url'), ('rollup', 'url')}
+
+    def test_percentiles(self):
+        box_office.metrics.samples = [('fetch', None, seconds / 100, 0, None) for seconds in range(1, 101)]
+        assert box_office.metrics.percentile('fetch', 0.5) == 0.50
+        assert box_office.metrics.percentile('fetch', 0.95) == 0.95
+        box_office.metrics.samples = [('parse', None, 0.1, 0, None), ('parse', None, 0.3, 0, None)]
+        assert box_office.metrics.percentile('parse', 0.5) == 0.1
+        assert box_office.metrics.percentile('parse', 0.95) == 0.3
+        box_office.metrics.samples = []
+        assert box_office.metrics.percentile('parse', 0.5) is None
+
+    def test_export(self):
+        with box_office.metrics.timer('fetch', 'url'):
+            pass
+        box_office.metrics.count('rows', 3)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        lines_path = os.path.join(directory.name, 'metrics.jsonl')
+        box_office.metrics.export(lines_path)
+        with open(lines_path) as lines:
+            assert [json.loads(line).get('stage') for line in lines] == ['fetch', None]
+        with box_office.metrics.timer('write', 'url', 'theater-url'):
+            pass
+        box_office.metrics.export(lines_path)
+        with open(lines_path) as lines:
+            assert json.loads(lines.readlines()[1])['theater'] == 'theater-url'
+        prom_path = os.path.join(directory.name, 'metrics.prom')
+        box_office.metrics.export(prom_path)
+        with open(prom_path) as prom:
+            text = prom.read()
+        assert 'box_office_stage_seconds_count{stage="fetch"} 1' in text
+        assert 'box_office_rows_total 3' in text
+
+
+class ConnectionTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'box_office.db')
+
+    def test_pragmas(self):
+        connection = box_office.connect(self.path)
+        self.addCleanup(connection.close)
+        assert connection.execute("PRAGMA journal_mode").fetchone() == ('wal',)
+        assert connection.execute("PRAGMA synchronous").fetchone() == (1,)
+        assert connection.execute("PRAGMA busy_timeout").fetchone() == (1000 * box_office.DB_BUSY_TIMEOUT,)
+
+    def test_reader_sees_writes_and_cannot_write(self):
+        box_office.use_database(self.path)
+        self.addCleanup(box_office.conn.close)
+        box_office.create_tables()
+        box_office.insert_theater('Cinemark Tinseltown', 'theater-url')
+        reader = box_office.connect(self.path, read_only=True)
+        self.addCleanup(reader.close)
+        assert reader.execute("SELECT theater_name FROM theaters").fetchall() == [('Cinemark Tinseltown',)]
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.execute("DELETE FROM theaters")
+
+
+    def test_earnings_read_under_write_lock(self):
+        box_office.use_database(self.path)
+        self.addCleanup(box_office.conn.close)
+        box_office.id_cache = box_office.IdCache()
+        box_office.create_tables()
+        box_office.insert_theater('Theater', 'theater-url')
+        box_office.insert_movie('The Shape of Water')
+        box_office.insert_movie_location(1, 1)
+        box_office.insert_screening('screening-1', 1, ['2018-01-25', '14:45'], 'Standard', 'True')
+        box_office.insert_ticket(1, 'Adult', 10)
+        box_office.insert_seats(1, [('A1', 'standard', 'reservedSeat')])
+        other = sqlite3.connect(self.path, timeout=0)
+        self.addCleanup(other.close)
+        screening_capacity_sold = box_office.screening_capacity_sold
+
+        def other_process_writes(screening_id):
+            with self.assertRaises(sqlite3.OperationalError):
+                other.execute("UPDATE screenings SET screening_estimated_earnings = 0")
+            return screening_capacity_sold(screening_id)
+
+        self.addCleanup(setattr, box_office, 'screening_capacity_sold', screening_capacity_sold)
+        box_office.screening_capacity_sold = other_process_writes
+        box_office.update_earnings(1)
+        assert other.execute("SELECT theater_estimated_earnings FROM theaters").fetchone() == (10,)
+
+
+class SeatSampleTest(unittest.TestCase):
+    def setUp(self):
+        use_memory_db()
+        box_office.insert_theater('Theater', 'theater-url')
+        box_office.insert_movie('The Shape of Water')
+        box_office.insert_movie_location(1, 1)
+        box_office.insert_screening('screening-1', 1, ['2018-01-25', '19:00'], 'Standard', 'True')
+        box_office.insert_ticket(1, 'Adult', 10)
+
+    def test_only_changes_stored(self):
+        seats = [('A1', 'standard', 'availableSeat'), ('A2', 'standard', 'availableSeat'),
+                 ('A3', 'unavailableSeat', 'unavailableSeat')]
+        assert box_office.insert_seat_sample(1, seats, '2018-01-24T19:00:00') == 3
+        seats[0] = ('A1', 'standard', 'reservedSeat')
+        assert box_office.insert_seat_sample(1, seats, '2018-01-25T18:00:00') == 1
+        assert box_office.insert_seat_sample(1, seats, '2018-01-25T18:57:00') == 0
+        assert box_office.from_db_get_seat_states(1) == {'A1': 'reservedSeat', 'A2': 'availableSeat',
+                                                         'A3': 'unavailableSeat'}
+        assert box_office.from_db_get_sales_curve(1) == [('2018-01-24T19:00:00', 0),
+                                                         ('2018-01-25T18:00:00', 1),
+                                                         ('2018-01-25T18:57:00', 1)]
+        box_office.c.execute("SELECT count(*) FROM seat_changes")
+        assert box_office.c.fetchone() == (4,)
+
+    def test_earnings_follow_latest_sample(self):
+        box_office.store_seat_sample(1, [('A1', 'standard', 'reservedSeat'),
+                                         ('A2', 'standard', 'availableSeat')])
+        box_office.store_seat_sample(1, [('A1', 'standard', 'reservedSeat'),
+                                         ('A2', 'standard', 'reservedSeat')])
+        box_office.c.execute("""SELECT screening_capacity, screening_seats_sold, theater_estimated_earnings
+                                FROM screenings, theaters""")
+        assert box_office.c.fetchone() == (2, 2, 20)
+
+    def test_sample_before_ticket_prices(self):
+        box_office.insert_screening('screening-2', 1, ['2018-01-25', '19:00'], 'Standard', 'True')
+        box_office.store_seat_sample(2, [('A1', 'standard', 'reservedSeat'),
+                                         ('A2', 'standard', 'availableSeat')])
+        assert box_office.from_db_get_sales_curve(2)[-1][1] == 1
+        box_office.c.execute("""SELECT screening_capacity, screening_seats_sold, screening_estimated_earnings
+                                FROM screenings WHERE screening_id = 2""")
+        assert box_office.c.fetchone() == (2, 1, None)
+
+    def test_failed_store_does_not_stop_scheduler(self):
+        now = box_office.datetime.datetime.now()
+        hour = box_office.datetime.timedelta(hours=1)
+        jobs = [(now, now + hour, 1, 'screening-1'), (now, now + hour, 2, 'screening-2')]
+        stored = []
+
+        def store(screening_id, seat_rows, screening_url):
+            if screening_id == 1:
+                raise TypeError('no ticket price')
+            stored.append(screening_id)
+
+        box_office.run_scheduler(jobs, fetch=lambda url: [], store=store)
+        assert stored == [2]
+
+    def test_sample_jobs(self):
+        box_office.insert_screening('screening-2', 1, ['2018-01-26', '12:00'], 'Standard', 'True')
+        now = box_office.datetime.datetime(2018, 1, 25, 18, 30)
+        jobs = box_office.seat_sample_jobs('2018-01-25', (1440, 60, 3), now)
+        assert sorted((job[0].strftime('%d %H:%M'), job[2]) for job in jobs) == [
+            ('25 18:57', 1), ('26 11:00', 2), ('26 11:57', 2)]
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        box_office.metrics = box_office.Metrics()
+
+    def test_written_in_order(self):
+        written = []
+        pipeline = box_office.Pipeline(lambda item: time.sleep(0.001 * (item % 3)) or item,
+                                       lambda item, fetched: fetched * 2,
+                                       lambda item, parsed: written.append(parsed),
+                                       workers=4, queue_size=2, name='test')
+        pipeline.run(range(50))
+        assert written == [item * 2 for item in range(50)]
+        counts = box_office.metrics.counts
+        assert (counts['test_fetched'], counts['test_parsed'], counts['test_written']) == (50, 50, 50)
+        assert box_office.metrics.stages() == ['pipeline']
+        assert box_office.metrics.samples[0][1] == 'test'
+
+    def test_fetching_waits_for_writes(self):
+        fetched = []
+        written = []
+        def write(item, parsed):
+            time.sleep(0.002)
+            written.append(item)
+            assert len(fetched) - len(written) <= 3 + 2 * 2
+        pipeline = box_office.Pipeline(fetched.append, lambda item, page: item, write,
+                                       workers=3, queue_size=2)
+        pipeline.run(range(30))
+        assert len(written) == 30
+        assert box_office.metrics.counts['pipeline_parsed_queue_full'] > 0
+
+    def test_error_stops_pipeline(self):
+        written = []
+        def parse(item, fetched):
+            if item == 5:
+                raise ValueError('bad page')
+            return item
+        pipeline = box_office.Pipeline(lambda item: item, parse,
+                                       lambda item, parsed: written.append(item), workers=2)
+        with self.assertRaises(ValueError):
+            pipeline.run(range(100))
+        assert written == [0, 1, 2, 3, 4]
+
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        for name, value in (('FETCH_BACKOFF', 0), ('rate_limiter', box_office.DomainRateLimiter(0)),
+                            ('circuit_breaker', box_office.HostCircuitBreaker(failures=3))):
+            self.addCleanup(setattr, box_office, name, getattr(box_office, name))
+            setattr(box_office, name, value)
+
+    def flaky(self, failures):
+        calls = []
+        def fetch():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise ConnectionError('connection reset')
+            return 'page'
+        return fetch, calls
+
+    def test_retried_until_success(self):
+        fetch, calls = self.flaky(2)
+        assert box_office.retry_fetch('https://www.example.com/a', fetch) == 'page'
+        assert len(calls) == 3
+
+    def test_missing_page_not_retried(self):
+        def fetch():
+            error = ConnectionError('not found')
+            error.status = 404
+            raise error
+        with self.assertRaises(ConnectionError):
+            box_office.retry_fetch('https://www.example.com/a', fetch)
+        assert box_office.circuit_breaker.failed['www.example.com'] == 0
+
+    def test_missing_element_fails_fast(self):
+        from selenium.common.exceptions import NoSuchElementException
+        calls = []
+        def fetch():
+            calls.append(1)
+            raise NoSuchElementException('NewCustomerCheckoutButton')
+        for page in range(4):
+            with self.assertRaises(NoSuchElementException):
+                box_office.retry_fetch('https://tickets.example.com/%s' % page, fetch)
+        assert len(calls) == 4
+        assert box_office.retry_fetch('https://tickets.example.com/ok', lambda: 'page') == 'page'
+
+    def test_transport_errors(self):
+        assert box_office.transport_error(urllib3.exceptions.ReadTimeoutError(None, 'url', 'timed out'))
+        assert box_office.transport_error(urllib3.exceptions.MaxRetryError(
+            None, 'url', urllib3.exceptions.NewConnectionError(None, 'refused')))
+        assert not box_office.transport_error(urllib3.exceptions.MaxRetryError(
+            None, 'url', urllib3.exceptions.ResponseError('too many redirects')))
+        assert box_office.transport_error(TimeoutException('page load'))
+        error = urllib3.exceptions.HTTPError('503')
+        error.status = 503
+        assert box_office.transport_error(error)
+        assert not box_office.transport_error(ValueError('no table'))
+
+    def test_circuit_opens_and_recovers(self):
+        now = [0]
+        breaker = box_office.circuit_breaker = box_office.HostCircuitBreaker(2, 60, lambda: now[0])
+        fetch, calls = self.flaky(10)
+        with self.assertRaises(box_office.CircuitOpenError):
+            box_office.retry_fetch('https://www.example.com/a', fetch)
+        assert len(calls) == 2
+        breaker.check('https://other.example.com/')
+        now[0] = 61
+        breaker.check('https://www.example.com/b')
+        with self.assertRaises(box_office.CircuitOpenError):
+            breaker.check('https://www.example.com/c')
+        breaker.success('https://www.example.com/b')
+        breaker.check('https://www.example.com/c')
+
+    def test_failed_ticket_page_queued(self):
+        use_memory_db()
+        box_office.insert_screening('https://www.example.com/s1', 1, ['2018-01-25', '19:00'],
+                                    'Standard', 'True')
+        box_office.insert_screening('https://www.example.com/s2', 1, ['2018-01-25', '20:00'],
+                                    'Standard', 'True')
+        def fetch_ticket_page(url):
+            if url.endswith('s1'):
+                raise ConnectionError('connection reset')
+            return fixture('tickets.html')
+        self.addCleanup(setattr, box_office, 'fetch_ticket_page', box_office.fetch_ticket_page)
+        box_office.fetch_ticket_page = fetch_ticket_page
+        box_office.get_ticket_prices('2018-01-25', 2, lambda: box_office.datetime.datetime(2018, 1, 25))
+        box_office.c.execute("SELECT count(*) FROM tickets WHERE screening_id = 2")
+        assert box_office.c.fetchone() == (3,)
+        box_office.c.execute("SELECT job_type, job_key, status FROM jobs")
+        assert box_office.c.fetchall() == [('tickets', 'https://www.example.com/s1', 'pending')]